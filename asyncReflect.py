@@ -0,0 +1,128 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from collStats import collectionLookup, collectionMembersQuery, cachedCollection, withoutDoc
+from movieDoc import exactTitleLookup, exactTitleQuery
+import phraseStats
+from phraseStats import phraseDocFreq, phraseCacheKey, MSEARCH_BATCH_SIZE
+import posParser
+from posParser import PhraseExtractor
+from queryPerDoc import seriesMovie, seriesScanQuery, reflectMovie, NUM_MOVIES_TO_SCAN
+from reflector import ReflectionMemo
+from instrument import esCall
+from esClient import asyncEsClient, asyncRestartingScan
+
+# Async variant of reflectSeries. Everything a Reflector would ask ES for
+# is fetched ahead of time on an AsyncElasticsearch client, landing in the
+# same caches the synchronous lookups read. Parsing runs in a process pool,
+# and the Reflector is then built from warm caches without an ES client,
+# so it never blocks the event loop.
+
+IN_FLIGHT = 32
+MAX_REQUESTS = 16
+
+async def _search(es, sem, index, body, kind='search'):
+    async with sem:
+        with esCall(kind):
+            return await es.search(index=index, body=body)
+
+
+async def _collection(es, sem, collId, index):
+    resp = cachedCollection(collId)
+    if resp is None:
+        resp = await _search(es, sem, index, collectionMembersQuery(collId), kind='collection')
+        collectionLookup.cache[collId] = resp
+    return resp
+
+
+async def _phraseStatsBatch(es, sem, phrases, index):
+    body = []
+    for phrase in phrases:
+        body.append({"index": index})
+        body.append(phraseStats._phraseQuery(phrase, popAggs=phraseStats.POP_AGGS))
+    async with sem:
+        with esCall('phrase_df_msearch'):
+            resp = await es.msearch(body=body)
+    for phrase, phraseResp in zip(phrases, resp['responses']):
+        if 'error' in phraseResp:
+            phraseResp = await _search(es, sem, index,
+                                       phraseStats._phraseQuery(phrase, popAggs=phraseStats.POP_AGGS),
+                                       kind='phrase_df')
+        phraseDocFreq.cache[phraseCacheKey(phrase)] = list(phraseStats._phraseStatsFromResp(phraseResp))
+
+
+async def _warmPhrases(es, sem, texts, index, batchSize=MSEARCH_BATCH_SIZE):
+    if phraseStats.OFFLINE_INDEX is not None:
+        # Answered locally as the Reflector asks
+        return
+    misses = [text for text in dict.fromkeys(texts)
+              if phraseDocFreq.cache.get(phraseCacheKey(text)) is None]
+    await asyncio.gather(*[_phraseStatsBatch(es, sem, misses[start:start + batchSize], index)
+                           for start in range(0, len(misses), batchSize)])
+
+
+async def reflectMovieAsync(es, sem, executor, docId, movie, index='tmdb', memo=None):
+    loop = asyncio.get_event_loop()
+    collResp, titleResp = await asyncio.gather(
+        _collection(es, sem, movie['belongs_to_collection']['id'], index),
+        _search(es, sem, index, exactTitleQuery(movie['title'], movie['id']), kind='exact_title'))
+    exactTitleLookup.prefetched[str(movie['id'])] = titleResp
+
+    collHits = withoutDoc(collResp, movie['id'])[0]['hits']['hits']
+    if memo is not None:
+        # Siblings already reflected this run need no parsing or lookups
+        collHits = [hit for hit in collHits
+                    if (str(hit['_source']['id']), 0) not in memo.reflections]
+    texts = [movie['overview']] + [hit['_source'].get('overview') for hit in collHits]
+    phrases = await loop.run_in_executor(executor, PhraseExtractor.createMany, texts)
+    await _warmPhrases(es, sem, set().union(*[p.propNouns for p in phrases]), index)
+
+    collPhrases = {hit['_id']: hitPhrases for hit, hitPhrases in zip(collHits, phrases[1:])}
+    # Everything the Reflector looks up is awaited above, so it gets no
+    # client rather than one that would block the loop
+    return reflectMovie(es=None, docId=docId, movie=movie, index=index,
+                        phrases=phrases[0], collPhrases=collPhrases, memo=memo)
+
+
+async def reflectSeriesAsync(es, index='tmdb', doc_type='movie',
+                             inFlight=IN_FLIGHT, maxRequests=MAX_REQUESTS, nlpWorkers=None,
+                             memo=None):
+    """ reflectSeries, keeping up to inFlight movies being reflected
+        at once while at most maxRequests ES requests are outstanding"""
+    sem = asyncio.Semaphore(maxRequests)
+    if memo is None:
+        memo = ReflectionMemo()
+    reflections = {}
+    pending = deque()
+    scanned = 0
+    with ProcessPoolExecutor(max_workers=nlpWorkers, initializer=posParser.warmUp,
+                             initargs=(posParser.NLP_MODEL, posParser.UNUSED_PIPES)) as executor:
+        async for hit in asyncRestartingScan(es, scroll='30m', index=index, doc_type=doc_type,
+                                             query=seriesScanQuery()):
+            if scanned >= NUM_MOVIES_TO_SCAN:
+                break
+            scanned += 1
+            movie = hit['_source']
+            if seriesMovie(movie):
+                pending.append(asyncio.ensure_future(
+                    reflectMovieAsync(es, sem, executor, hit['_id'], movie, index=index,
+                                      memo=memo)))
+            # Collect in scan order so output matches reflectSeries
+            while len(pending) >= inFlight:
+                title, reflection = await pending.popleft()
+                reflections[title] = reflection
+        while pending:
+            title, reflection = await pending.popleft()
+            reflections[title] = reflection
+    print("Collection siblings %s" % memo)
+    return reflections
+
+
+def reflectSeriesWithAsync(index='tmdb', doc_type='movie', **kwargs):
+    async def run():
+        es = asyncEsClient()
+        try:
+            return await reflectSeriesAsync(es, index=index, doc_type=doc_type, **kwargs)
+        finally:
+            await es.close()
+    return asyncio.run(run())
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+import queryPerDoc
+from queryPerDoc import reflectSeries, invertReflections, negativeSampler, toJudgList, iterJudgments
+from collStats import collectionLookup, prefetchCollections
+import phraseStats
+from phraseStats import phraseStatsMany, phraseDocFreq
+from phraseIndex import buildPhraseIndex
+from movieDoc import exactTitleLookup
+from reflector import ReflectionMemo
+from queryCandidate import resetTables
+from cacheStore import CacheStore
+from posParser import PhraseExtractor
+from judgments import judgmentsToFile
+from spillInvert import SpilledInversion
+from fakeEs import FakeElasticsearch, synthMovies
+
+# Benchmarks the pipeline's stages against FakeElasticsearch over a
+# synthetic corpus, so performance changes can be compared without a live
+# tmdb index. Each benchmark runs once timed, then again under tracemalloc
+# for its peak memory. The ES and sqlite caches are fresh for every run.
+# docs are what a benchmark works through: the series movies reflected,
+# or for phraseStats the phrases looked up.
+
+BENCH_SIZES = [1000, 10000, 100000]
+BENCHMARKS = ['reflector', 'phraseStats', 'invert', 'write']
+
+# Phrases looked up by the phraseStats benchmark
+BENCH_PHRASES = 2000
+
+@contextmanager
+def freshCaches():
+    """ Point the phrase df, collection and extraction caches at an
+        empty sqlite file for the duration, restoring them after"""
+    tmpDir = tempfile.mkdtemp(prefix='bench')
+    saved = (phraseDocFreq.cache, collectionLookup.cache, collectionLookup.index, PhraseExtractor.cache)
+    phraseDocFreq.cache = CacheStore(table='phrase_df', path=os.path.join(tmpDir, 'cache.db'))
+    collectionLookup.cache = CacheStore(table='collection', path=os.path.join(tmpDir, 'cache.db'))
+    PhraseExtractor.cache = CacheStore(table='extractions', path=os.path.join(tmpDir, 'cache.db'))
+    collectionLookup.index = {}
+    exactTitleLookup.prefetched.clear()
+    try:
+        yield tmpDir
+    finally:
+        phraseDocFreq.cache, collectionLookup.cache, collectionLookup.index, PhraseExtractor.cache = saved
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def benchPhrases(movies, numPhrases=BENCH_PHRASES, seed=0):
+    """ Titles and capitalized overview words, like the proper nouns
+        reflection looks up"""
+    phrases = {movie['title'] for movie in movies}
+    phrases.update(word.strip('.') for movie in movies
+                   for word in movie['overview'].split() if word[:1].isupper())
+    phrases = sorted(phrases)
+    return random.Random(seed).sample(phrases, min(numPhrases, len(phrases)))
+
+
+def benchReflector(es, movies, state, prefetch=True):
+    queryPerDoc.NUM_MOVIES_TO_SCAN = len(movies)
+    memo = ReflectionMemo()
+    with freshCaches():
+        if prefetch:
+            prefetchCollections(es)
+        reflections = reflectSeries(es, memo=memo)
+    state['reflections'] = reflections
+    return len(reflections), {'siblingsBuilt': memo.built, 'siblingsReused': memo.reused}
+
+
+def benchPhraseStats(es, movies, state, popAggs=None):
+    phrases = state['phrases']
+    stats = phraseStatsMany(phrases, es, popAggs=popAggs)
+    return len(stats), {}
+
+
+def benchInvert(es, movies, state, spill=False):
+    reflections = state['reflections']
+    if isinstance(state.get('inverted'), SpilledInversion):
+        state['inverted'].close()
+    if spill:
+        inverted = SpilledInversion().addAll(reflections.items())
+        negatives = inverted.negativeSampler()
+    else:
+        inverted = invertReflections(reflections)
+        negatives = negativeSampler(reflections, inverted)
+    judgments, numQueries = toJudgList(inverted, negatives=negatives)
+    state['inverted'], state['negatives'] = inverted, negatives
+    return len(reflections), {'judgments': len(judgments), 'queries': numQueries - 1}
+
+
+def benchWrite(es, movies, state):
+    with freshCaches() as tmpDir:
+        numQueries = judgmentsToFile(os.path.join(tmpDir, 'judgments.txt'),
+                                     iterJudgments(state['inverted'], negatives=state['negatives']))
+    return len(state['reflections']), {'queries': numQueries}
+
+
+def _measure(bench, memory=True):
+    start = time.perf_counter()
+    docs, extra = bench()
+    seconds = time.perf_counter() - start
+    result = {'docs': docs, 'seconds': seconds,
+              'docsPerSec': docs / seconds if seconds else None,
+              'peakMB': None}
+    result.update(extra)
+    if memory:
+        tracemalloc.start()
+        try:
+            bench()
+            result['peakMB'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def runBenchmarks(sizes=BENCH_SIZES, benchmarks=BENCHMARKS, memory=True, prefetch=True,
+                  popAggs=None, numPhrases=BENCH_PHRASES, seed=0, offline=False, spill=False,
+                  **corpusArgs):
+    """ Run benchmarks over a synthetic corpus of each size, returning
+        a result dict per (size, benchmark). invert and write need the
+        reflector benchmark's reflections, which are built untimed if
+        it isn't being run. offline answers phrase stats from a
+        phraseIndex of the corpus, built untimed. spill inverts through
+        a SpilledInversion"""
+    benches = {
+        'reflector': lambda es, movies, state: benchReflector(es, movies, state, prefetch=prefetch),
+        'phraseStats': lambda es, movies, state: benchPhraseStats(es, movies, state, popAggs=popAggs),
+        'invert': lambda es, movies, state: benchInvert(es, movies, state, spill=spill),
+        'write': benchWrite
+    }
+    results = []
+    for size in sizes:
+        # The last size's candidates are dropped with its state, so don't
+        # carry their phrases and docs into this one's memory
+        resetTables()
+        movies = synthMovies(size, seed=seed, **corpusArgs)
+        es = FakeElasticsearch(movies)
+        es.warm()
+        state = {'phrases': benchPhrases(movies, numPhrases=numPhrases, seed=seed)}
+        indexDir = tempfile.mkdtemp(prefix='benchIndex')
+        if offline:
+            buildPhraseIndex(movies, indexDir)
+            phraseStats.setOfflineIndex(indexDir)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            if 'reflector' not in benchmarks and {'invert', 'write'} & set(benchmarks):
+                benchReflector(es, movies, state, prefetch=prefetch)
+            if 'invert' not in benchmarks and 'write' in benchmarks:
+                benchInvert(es, movies, state, spill=spill)
+            for name in BENCHMARKS:
+                if name in benchmarks:
+                    result = _measure(lambda: benches[name](es, movies, state), memory=memory)
+                    result.update({'benchmark': name, 'size': size})
+                    results.append(result)
+        phraseStats.setOfflineIndex(None)
+        shutil.rmtree(indexDir, ignore_errors=True)
+        if isinstance(state.get('inverted'), SpilledInversion):
+            state['inverted'].close()
+    return results
+
+
+def printResults(results):
+    print("%-12s %8s %8s %9s %11s %9s  %s" % ('benchmark', 'size', 'docs', 'seconds',
+                                             'docs/sec', 'peak MB', 'other'))
+    for result in results:
+        other = {key: value for key, value in result.items()
+                 if key not in ('benchmark', 'size', 'docs', 'seconds', 'docsPerSec', 'peakMB')}
+        print("%-12s %8s %8s %9.2f %11.1f %9s  %s" % (
+            result['benchmark'], result['size'], result['docs'], result['seconds'],
+            result['docsPerSec'] or 0.0,
+            '-' if result['peakMB'] is None else '%.1f' % result['peakMB'],
+            ' '.join('%s=%s' % item for item in sorted(other.items()))))
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark reflection, phrase stats, inversion and writing '
+                                        'against an in memory fake ES over a synthetic corpus')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES,
+                        help='Corpus sizes (docs) to benchmark')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--collection-size', type=int, nargs=2, default=(2, 8),
+                        metavar=('MIN', 'MAX'), help='Movies per collection')
+    parser.add_argument('--overview-words', type=int, nargs=2, default=(30, 90),
+                        metavar=('MIN', 'MAX'), help='Words per overview')
+    parser.add_argument('--series-fraction', type=float, default=0.5,
+                        help='Fraction of movies belonging to a collection')
+    parser.add_argument('--phrases', type=int, default=BENCH_PHRASES,
+                        help='Phrases looked up by the phraseStats benchmark')
+    parser.add_argument('--aggs', action='store_true',
+                        help='Compute popularity ranges with aggregations in phraseStats')
+    parser.add_argument('--offline', action='store_true',
+                        help='Answer phrase stats from a phraseIndex of the corpus rather than ES')
+    parser.add_argument('--spill', action='store_true',
+                        help='Invert through sorted runs spilled to disk')
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+                        help='Look collections up per movie rather than prefetching them all')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Skip the second, tracemalloc run of each benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Also write results as JSON here')
+    args = parser.parse_args()
+
+    results = runBenchmarks(sizes=args.sizes, benchmarks=args.benchmarks, memory=args.memory,
+                            prefetch=args.prefetch, popAggs=args.aggs, numPhrases=args.phrases,
+                            seed=args.seed, offline=args.offline, spill=args.spill,
+                            collectionSize=tuple(args.collection_size),
+                            overviewWords=tuple(args.overview_words),
+                            seriesFraction=args.series_fraction)
+    printResults(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+
+CACHE_DB = 'synth_cache.db'
+
+# Keys per sqlite statement in bulk reads, under its variable limit
+BULK_KEYS = 500
+
+# Seconds cached ES lookups (phrase doc frequencies, collection members)
+# are reused for, after which they're looked up again, so later runs see
+# movies added or edited since
+LOOKUP_TTL = 24 * 60 * 60
+
+class CacheStore:
+    """ Persistent key/value cache backed by a table in a sqlite
+        file, written through on every put so a crash loses nothing
+        and several worker processes can share one file.
+
+        A bounded LRU of recently used values sits in front of sqlite.
+        Values are json serializable, callers shouldn't mutate what
+        get returns as it may be shared through the LRU.
+
+        Entries older than ttl seconds when the store was opened are
+        expired, so those put during a run last the run (callers
+        warming the cache can count on them) however short the ttl."""
+
+    def __init__(self, table, path=CACHE_DB, ttl=None, lruSize=10000):
+        self.table = table
+        self.path = path
+        self.ttl = ttl
+        self.opened = time.time()
+        self.lruSize = lruSize
+        self.lru = OrderedDict()
+        self._conn = None
+        self._pid = None
+
+    def _db(self):
+        # sqlite connections must not cross a fork, so each process
+        # opens its own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS "%s" '
+                               '(key TEXT PRIMARY KEY, value TEXT, ts REAL)' % self.table)
+            self._conn.commit()
+            self._pid = os.getpid()
+            self.lru.clear()
+        return self._conn
+
+    def _expired(self, ts):
+        return self.ttl is not None and ts < self.opened - self.ttl
+
+    def _remember(self, key, value, ts):
+        self.lru[key] = (value, ts)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lruSize:
+            self.lru.popitem(last=False)
+
+    def get(self, key, default=None):
+        key = str(key)
+        db = self._db()
+        if key in self.lru:
+            value, ts = self.lru[key]
+            if not self._expired(ts):
+                self.lru.move_to_end(key)
+                return value
+            del self.lru[key]
+        row = db.execute('SELECT value, ts FROM "%s" WHERE key=?' % self.table, (key,)).fetchone()
+        if row is None or self._expired(row[1]):
+            return default
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        return value
+
+    def put(self, key, value):
+        key = str(key)
+        ts = time.time()
+        db = self._db()
+        with db:
+            db.execute('INSERT OR REPLACE INTO "%s" (key, value, ts) VALUES (?, ?, ?)' % self.table,
+                       (key, json.dumps(value), ts))
+        self._remember(key, value, ts)
+
+    def getMany(self, keys, touch=False):
+        """ Dict of each of keys found to its value, in one query per
+            BULK_KEYS. touch marks the rows used now, keeping them
+            through compact(olderThan=)"""
+        rVal = {}
+        db = self._db()
+        misses = []
+        for key in dict.fromkeys(str(key) for key in keys):
+            if key in self.lru and not self._expired(self.lru[key][1]):
+                self.lru.move_to_end(key)
+                rVal[key] = self.lru[key][0]
+            else:
+                misses.append(key)
+        for start in range(0, len(misses), BULK_KEYS):
+            batch = misses[start:start + BULK_KEYS]
+            rows = db.execute('SELECT key, value, ts FROM "%s" WHERE key IN (%s)'
+                              % (self.table, ','.join('?' * len(batch))), batch).fetchall()
+            for key, value, ts in rows:
+                if not self._expired(ts):
+                    rVal[key] = json.loads(value)
+                    self._remember(key, rVal[key], ts)
+        if touch and rVal:
+            ts = time.time()
+            found = list(rVal)
+            with db:
+                for start in range(0, len(found), BULK_KEYS):
+                    batch = found[start:start + BULK_KEYS]
+                    db.execute('UPDATE "%s" SET ts=? WHERE key IN (%s)'
+                               % (self.table, ','.join('?' * len(batch))), [ts] + batch)
+            for key in found:
+                self.lru[key] = (rVal[key], ts)
+        return rVal
+
+    def putMany(self, items):
+        """ put each (key, value) of items, in one transaction"""
+        ts = time.time()
+        items = [(str(key), value) for key, value in items]
+        db = self._db()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO "%s" (key, value, ts) VALUES (?, ?, ?)' % self.table,
+                           [(key, json.dumps(value), ts) for key, value in items])
+        for key, value in items:
+            self._remember(key, value, ts)
+
+    def compact(self, olderThan=None):
+        """ Delete expired rows, and those not put (or touched) in the
+            last olderThan seconds, then reclaim the file's free space.
+            Returns the rows deleted"""
+        maxAges = [age for age in (self.ttl, olderThan) if age is not None]
+        db = self._db()
+        deleted = 0
+        if maxAges:
+            with db:
+                deleted = db.execute('DELETE FROM "%s" WHERE ts < ?' % self.table,
+                                     (time.time() - min(maxAges),)).rowcount
+        self.lru.clear()
+        db.execute('VACUUM')
+        return deleted
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM "%s"' % self.table).fetchone()[0]
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Compact a table of the cache')
+    parser.add_argument('table', help='ie phrase_df, collection or extractions')
+    parser.add_argument('--path', default=CACHE_DB)
+    parser.add_argument('--older-than-days', type=float, default=None,
+                        help='Also drop rows not used in this many days')
+    args = parser.parse_args()
+
+    cache = CacheStore(table=args.table, path=args.path)
+    olderThan = args.older_than_days * 24 * 3600 if args.older_than_days is not None else None
+    deleted = cache.compact(olderThan=olderThan)
+    print("Deleted %s rows, %s left" % (deleted, len(cache)))
@@ -1,57 +1,138 @@
-import os
-import atexit
-import json
-from popularity import moviePopRange
-from elasticsearch import Elasticsearch
-from movieDoc import byCollPhrase
+from math import ceil
+from cacheStore import CacheStore, LOOKUP_TTL
+from instrument import esCall, cacheLookup
+from popularity import moviePopRange, popRangeAggs, popRangeFromAggs
+from esClient import esClient
+from movieDoc import byCollPhrase, MOVIE_FIELDS
 
-def collectionLookup(es, collId, docId, index='tmdb'):
-    collQ = {
-        "size": 50,
-        "sort": [
-            {"vote_average": "desc"}
-        ],
-        "query": {
-            "bool": {
-                "must": [
-                    {"match": {
-                        "belongs_to_collection.id": collId}}
-                ]
-            }
+COLLECTION_SIZE = 50
+COLLECTION_SORT = [
+    {"vote_average": "desc"}
+]
+COLLECTION_PARTITION_SIZE = 1000
+
+def _collectionQuery(collId):
+    return {
+        "bool": {
+            "must": [
+                {"match": {
+                    "belongs_to_collection.id": collId}}
+            ]
         }
     }
 
-    resp = es.search(index=index, body=collQ)
-    collectionLookup.cache[collId] = resp
 
+def collectionMembersQuery(collId):
+    return {
+        "size": COLLECTION_SIZE,
+        "sort": COLLECTION_SORT,
+        "_source": MOVIE_FIELDS,
+        "query": _collectionQuery(collId)
+    }
+
+
+def cachedCollection(collId):
+    """ A collection's members response if prefetched or cached"""
+    resp = collectionLookup.index.get(str(collId))
+    if resp is None:
+        resp = collectionLookup.cache.get(collId)
+    return resp
+
+
+def collectionLookup(es, collId, docId, index='tmdb'):
+    resp = cachedCollection(collId)
+    cacheLookup('collection', resp is not None)
+    if resp is None:
+        with esCall('collection'):
+            resp = es.search(index=index, body=collectionMembersQuery(collId))
+        collectionLookup.cache[collId] = resp
+
+    return withoutDoc(resp, docId)
+
+
+def withoutDoc(resp, docId):
+    """ A collection lookup's (resp, minPop, maxPop), with docId
+        dropped from the hits"""
     minPop, maxPop = moviePopRange(resp['hits']['hits'])
-    delIdx = False
-    for idx, hit in enumerate(resp['hits']['hits']):
-        if str(hit['_id']) == str(docId):
-            delIdx = idx
-    if delIdx:
-        del resp['hits']['hits'][delIdx]
+    # Cached responses are shared, so copy rather than delete in place
+    resp = dict(resp)
+    resp['hits'] = dict(resp['hits'])
+    resp['hits']['hits'] = [hit for hit in resp['hits']['hits']
+                            if str(hit['_id']) != str(docId)]
     return resp, minPop, maxPop
 
-collectionLookup.cache = {}
-if os.path.exists('coll_cache.json'):
-    with open('coll_cache.json') as f:
-        collectionLookup.cache = json.load(f)
+def collectionPopRange(es, collId, index='tmdb'):
+    """ Just the (minPop, maxPop) of a collection, computed
+        server side without fetching its members"""
+    collQ = {
+        "size": 0,
+        "query": _collectionQuery(collId),
+        "aggs": popRangeAggs()
+    }
+    resp = es.search(index=index, body=collQ)
+    return popRangeFromAggs(resp['aggregations'])
+
+def prefetchCollections(es, index='tmdb', partitionSize=COLLECTION_PARTITION_SIZE):
+    """ Fill collectionLookup.index with every collection's members in
+        one pass of terms aggregations, each bucket carrying the same
+        top 50 by vote_average collectionLookup would search for"""
+    cardQ = {
+        "size": 0,
+        "aggs": {
+            "collections": {"cardinality": {"field": "belongs_to_collection.id"}}
+        }
+    }
+    with esCall('collection_prefetch'):
+        resp = es.search(index=index, body=cardQ)
+    numPartitions = max(1, int(ceil(resp['aggregations']['collections']['value'] / partitionSize)))
+    for partition in range(numPartitions):
+        collQ = {
+            "size": 0,
+            "aggs": {
+                "collections": {
+                    "terms": {
+                        "field": "belongs_to_collection.id",
+                        "size": partitionSize * 2,
+                        "include": {"partition": partition, "num_partitions": numPartitions}
+                    },
+                    "aggs": {
+                        "members": {
+                            "top_hits": {
+                                "size": COLLECTION_SIZE,
+                                "sort": COLLECTION_SORT,
+                                "_source": MOVIE_FIELDS
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        with esCall('collection_prefetch'):
+            resp = es.search(index=index, body=collQ)
+        for bucket in resp['aggregations']['collections']['buckets']:
+            collectionLookup.index[str(bucket['key'])] = {"hits": bucket['members']['hits']}
+    print("Prefetched %s collections" % len(collectionLookup.index))
+    return collectionLookup.index
 
+def refreshCollections(es, collIds, index='tmdb'):
+    """ Search each of collIds' members afresh, replacing what's
+        prefetched or cached, as their members have changed"""
+    for collId in collIds:
+        with esCall('collection'):
+            resp = es.search(index=index, body=collectionMembersQuery(collId))
+        collectionLookup.index[str(collId)] = resp
+        collectionLookup.cache[collId] = resp
+    return collectionLookup.index
 
-@atexit.register
-def dumpCache():
-    with open('coll_cache.json', 'w') as f:
-        print('writing coll cache')
-        json.dump(collectionLookup.cache, f)
+collectionLookup.cache = CacheStore(table='collection', ttl=LOOKUP_TTL)
+# Collections prefetched for this run, keyed by collection id
+collectionLookup.index = {}
 
 if __name__ == "__main__":
-    es = Elasticsearch()
+    es = esClient()
     from sys import argv
     for movie in byCollPhrase(collNameSearch=argv[1], es=es):
         print(movie['belongs_to_collection']['name'])
         collId=movie['belongs_to_collection']['id']
-        resp, minPop, maxPop = collectionLookup(es=es,
-                                          collId=collId,
-                                          docId=None)
+        minPop, maxPop = collectionPopRange(es=es, collId=collId)
         print("minPop %s maxPop %s" % (minPop, maxPop))
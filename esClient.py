@@ -0,0 +1,256 @@
+import json
+import time
+import random
+import asyncio
+import logging
+from functools import partial
+from threading import Event, Lock
+from elasticsearch import Elasticsearch, ConnectionError, TransportError
+from instrument import cacheLookup
+
+# The one place ES clients are built. Clients get a connection pool sized
+# for pool workers' threads and sliced scans, gzipped requests and a
+# timeout, and are wrapped to retry timeouts and busy responses with
+# jittered backoff and to coalesce identical concurrent searches, so
+# reflectors asking for the same phrase or collection at the same time
+# share one round trip. Coalescing is within a process, across pool
+# workers the caches do that job.
+
+# Nodes to connect to, None for the client's default of localhost:9200
+ES_HOSTS = None
+
+# Connections kept open to each node
+POOL_MAXSIZE = 32
+
+# Seconds before a request times out (and is retried)
+TIMEOUT = 30
+
+HTTP_COMPRESS = True
+
+# Retries of a timed out or busy request, each after a jittered
+# exponential backoff starting at RETRY_BACKOFF seconds
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# Statuses of the cluster being busy rather than the request being wrong
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Read requests safe to retry, search and msearch are also coalesced. Not
+# scroll, a scroll that timed out may still have moved the cursor on, so
+# retrying it can skip a page. Scans are started over instead, see
+# restartingScan
+RETRIED = ('search', 'msearch', 'count', 'get', 'mget')
+
+logger = logging.getLogger('esClient')
+
+
+def clientSettings(**overrides):
+    """ Client kwargs, retries are left to the wrapper so they back off
+        rather than go again straight away"""
+    settings = dict(maxsize=POOL_MAXSIZE, timeout=TIMEOUT, http_compress=HTTP_COMPRESS,
+                    retry_on_timeout=False, max_retries=0)
+    settings.update(overrides)
+    return settings
+
+
+def retryable(e):
+    """ Whether e is a timeout or the cluster being busy, rather
+        than the request being wrong"""
+    if isinstance(e, ConnectionError):
+        # Including ConnectionTimeout
+        return True
+    return isinstance(e, TransportError) and e.status_code in RETRY_STATUSES
+
+
+def backoff(attempt):
+    """ Seconds to wait before going again after attempt, jittered"""
+    return RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def _requestKey(method, args, kwargs):
+    return json.dumps([method, args, kwargs], sort_keys=True, default=str)
+
+
+class _InFlight:
+    """ A request under way, for identical ones to wait on"""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CoalescingClient:
+    """ Wraps an Elasticsearch client, retrying reads and coalescing
+        identical search / msearch calls made while one is in flight
+        (ie from other threads) into a single request. Callers share
+        the response, so mustn't change it in place, as with the
+        caches. Requests opening a scroll aren't coalesced. Anything
+        else is passed through to the client"""
+
+    def __init__(self, es, retries=MAX_RETRIES):
+        self.es = es
+        self.retries = retries
+        self._lock = Lock()
+        self._inFlight = {}
+
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(self.es, method)(*args, **kwargs)
+            except TransportError as e:
+                if attempt == self.retries or not retryable(e):
+                    raise
+                logger.warning("Retrying %s after %s", method, e)
+                time.sleep(backoff(attempt))
+
+    def _coalesced(self, method, *args, **kwargs):
+        if 'scroll' in kwargs:
+            return self._call(method, *args, **kwargs)
+        key = _requestKey(method, args, kwargs)
+        with self._lock:
+            call = self._inFlight.get(key)
+            joined = call is not None
+            if not joined:
+                call = self._inFlight[key] = _InFlight()
+        cacheLookup('in_flight_%s' % method, joined)
+        if joined:
+            return call.wait()
+        try:
+            call.result = self._call(method, *args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inFlight[key]
+            call.done.set()
+
+    def search(self, *args, **kwargs):
+        return self._coalesced('search', *args, **kwargs)
+
+    def msearch(self, *args, **kwargs):
+        return self._coalesced('msearch', *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in RETRIED:
+            return partial(self._call, name)
+        return getattr(self.es, name)
+
+
+class AsyncCoalescingClient:
+    """ CoalescingClient for an AsyncElasticsearch client, identical
+        searches awaited at once by several tasks sharing one request"""
+
+    def __init__(self, es, retries=MAX_RETRIES):
+        self.es = es
+        self.retries = retries
+        self._inFlight = {}
+
+    async def _call(self, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return await getattr(self.es, method)(*args, **kwargs)
+            except TransportError as e:
+                if attempt == self.retries or not retryable(e):
+                    raise
+                logger.warning("Retrying %s after %s", method, e)
+                await asyncio.sleep(backoff(attempt))
+
+    async def _coalesced(self, method, *args, **kwargs):
+        if 'scroll' in kwargs:
+            return await self._call(method, *args, **kwargs)
+        key = _requestKey(method, args, kwargs)
+        call = self._inFlight.get(key)
+        cacheLookup('in_flight_%s' % method, call is not None)
+        if call is not None:
+            # Shielded, so one waiter being cancelled doesn't cancel the rest
+            return await asyncio.shield(call)
+        call = self._inFlight[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await self._call(method, *args, **kwargs)
+            call.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # Marks it retrieved when nobody else was waiting
+            call.exception()
+            raise
+        finally:
+            del self._inFlight[key]
+
+    async def search(self, *args, **kwargs):
+        return await self._coalesced('search', *args, **kwargs)
+
+    async def msearch(self, *args, **kwargs):
+        return await self._coalesced('msearch', *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in RETRIED:
+            return partial(self._call, name)
+        return getattr(self.es, name)
+
+
+def esClient(hosts=ES_HOSTS, retries=MAX_RETRIES, **settings):
+    """ An Elasticsearch client, settings overriding clientSettings"""
+    return CoalescingClient(Elasticsearch(hosts, **clientSettings(**settings)), retries=retries)
+
+
+def asyncEsClient(hosts=ES_HOSTS, retries=MAX_RETRIES, **settings):
+    """ esClient, on an AsyncElasticsearch client"""
+    from elasticsearch import AsyncElasticsearch
+    return AsyncCoalescingClient(AsyncElasticsearch(hosts, **clientSettings(**settings)), retries=retries)
+
+
+def restartingScan(es, retries=MAX_RETRIES, **kwargs):
+    """ helpers.scan, started over should it fail on a timeout or a busy
+        cluster. Hits yielded before the restart are skipped, by _id, as
+        the scroll order needn't be the same the second time"""
+    from elasticsearch.helpers import scan
+    seen = set()
+    for attempt in range(retries + 1):
+        hits = scan(es, **kwargs)
+        try:
+            for hit in hits:
+                if hit['_id'] not in seen:
+                    seen.add(hit['_id'])
+                    yield hit
+            return
+        except TransportError as e:
+            if attempt == retries or not retryable(e):
+                raise
+            logger.warning("Restarting scan after %s", e)
+            time.sleep(backoff(attempt))
+        finally:
+            # Clears its scroll
+            hits.close()
+
+
+async def asyncRestartingScan(es, retries=MAX_RETRIES, **kwargs):
+    """ restartingScan, over async_scan"""
+    from elasticsearch.helpers import async_scan
+    seen = set()
+    for attempt in range(retries + 1):
+        hits = async_scan(es, **kwargs)
+        try:
+            async for hit in hits:
+                if hit['_id'] not in seen:
+                    seen.add(hit['_id'])
+                    yield hit
+            return
+        except TransportError as e:
+            if attempt == retries or not retryable(e):
+                raise
+            logger.warning("Restarting scan after %s", e)
+            await asyncio.sleep(backoff(attempt))
+        finally:
+            await hits.aclose()
@@ -0,0 +1,347 @@
+import re
+import zlib
+import random
+from itertools import count
+from popularity import moviePopularities
+
+# An in memory stand in for the tmdb index, answering the search, msearch
+# and scroll (helpers.scan) request shapes this project sends. Only the
+# query, sort and aggregation features used here are implemented, scored
+# very roughly. text_all.en is the title and overview, tokenized on word
+# characters and lowercased without stemming or stopwords.
+
+SHARDS = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+
+# Position gap between the values of a multi valued (or copy_to) field
+POSITION_GAP = 100
+
+# Fields mapped as numbers, matched by value even when queried with a string
+NUMERIC_FIELDS = {'id', 'belongs_to_collection.id', 'vote_count', 'vote_average'}
+
+def _tokens(text):
+    return re.findall(r'\w+', text.lower()) if isinstance(text, str) else []
+
+
+def _path(doc, field):
+    for part in field.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+class FakeElasticsearch:
+
+    def __init__(self, movies, index='tmdb'):
+        self.index = index
+        self.movies = list(movies)
+        self.ids = [str(movie['id']) for movie in self.movies]
+        self.idxById = {docId: idx for idx, docId in enumerate(self.ids)}
+        self.fieldIndexes = {}
+        self.scrolls = {}
+        self.scrollIds = count()
+        self.calls = {}
+
+    def _count(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def warm(self):
+        """ Build the indexes the pipeline's queries use up front,
+            rather than on the first query to need each"""
+        for field in ('text_all.en', 'title'):
+            self._positions(field)
+        self._values('belongs_to_collection.id')
+
+    def _fieldTexts(self, movie, field):
+        if field == 'text_all.en':
+            return [movie.get('title'), movie.get('overview')]
+        return [_path(movie, field)]
+
+    def _positions(self, field):
+        """ Positional index of a text field, term -> {docIdx: [pos...]}.
+            Like copy_to, each value copied in starts POSITION_GAP on"""
+        if field not in self.fieldIndexes:
+            postings = {}
+            for docIdx, movie in enumerate(self.movies):
+                start = 0
+                for text in self._fieldTexts(movie, field):
+                    tokens = _tokens(text)
+                    for pos, term in enumerate(tokens, start):
+                        postings.setdefault(term, {}).setdefault(docIdx, []).append(pos)
+                    start += len(tokens) + POSITION_GAP
+            self.fieldIndexes[field] = postings
+        return self.fieldIndexes[field]
+
+    def _values(self, field):
+        """ Exact value index of a keyword or numeric field, value -> [docIdx...]"""
+        key = ('values', field)
+        if key not in self.fieldIndexes:
+            values = {}
+            for docIdx, movie in enumerate(self.movies):
+                value = _path(movie, field)
+                if value is not None:
+                    values.setdefault(str(value), []).append(docIdx)
+            self.fieldIndexes[key] = values
+        return self.fieldIndexes[key]
+
+    def _matchPhrase(self, field, phrase):
+        if field == 'title_sent':
+            # Sentinels pin the phrase to the whole title
+            terms = [term for term in _tokens(phrase) if term not in ('sentinel_begin', 'sentinel_end')]
+            return {docIdx: 1.0 for docIdx in self._matchPhrase('title', ' '.join(terms))
+                    if len(_tokens(self.movies[docIdx].get('title'))) == len(terms)}
+        terms = _tokens(phrase)
+        if not terms:
+            return {}
+        postings = self._positions(field)
+        termPostings = [postings.get(term, {}) for term in terms]
+        rVal = {}
+        for docIdx in set.intersection(*[set(p) for p in termPostings]):
+            starts = set(termPostings[0][docIdx])
+            for offset, posting in enumerate(termPostings[1:], 1):
+                starts &= {pos - offset for pos in posting[docIdx]}
+            if starts:
+                rVal[docIdx] = float(len(starts))
+        return rVal
+
+    def _match(self, field, value):
+        if field == '_id' or field in NUMERIC_FIELDS or not isinstance(value, str):
+            if field == '_id':
+                docIdx = self.idxById.get(str(value))
+                return {} if docIdx is None else {docIdx: 1.0}
+            return {docIdx: 1.0 for docIdx in self._values(field).get(str(value), ())}
+        postings = self._positions(field)
+        rVal = {}
+        for term in _tokens(value):
+            for docIdx, positions in postings.get(term, {}).items():
+                rVal[docIdx] = rVal.get(docIdx, 0.0) + len(positions)
+        return rVal
+
+    def _eval(self, query):
+        """ Matching docs of a query, docIdx -> score"""
+        (kind, clause), = query.items()
+        if kind == 'match_all':
+            return {docIdx: 1.0 for docIdx in range(len(self.movies))}
+        if kind in ('match', 'match_phrase'):
+            (field, value), = clause.items()
+            boost = 1.0
+            if isinstance(value, dict):
+                boost = value.get('boost', 1.0)
+                value = value['query']
+            matches = self._matchPhrase(field, value) if kind == 'match_phrase' \
+                else self._match(field, value)
+            return {docIdx: score * boost for docIdx, score in matches.items()}
+        if kind == 'exists':
+            return {docIdx: 1.0 for docIdx, movie in enumerate(self.movies)
+                    if _path(movie, clause['field']) is not None}
+        if kind == 'ids':
+            return {self.idxById[str(docId)]: 1.0 for docId in clause['values']
+                    if str(docId) in self.idxById}
+        if kind == 'bool':
+            return self._evalBool(clause)
+        raise ValueError("FakeElasticsearch can't run %s queries" % kind)
+
+    def _evalBool(self, clause):
+        def clauses(occur):
+            queries = clause.get(occur, [])
+            return queries if isinstance(queries, list) else [queries]
+        rVal = None
+        for query in clauses('must'):
+            matches = self._eval(query)
+            rVal = matches if rVal is None else \
+                {docIdx: score + matches[docIdx] for docIdx, score in rVal.items() if docIdx in matches}
+        for query in clauses('filter'):
+            matches = self._eval(query)
+            rVal = {docIdx: 0.0 for docIdx in matches} if rVal is None else \
+                {docIdx: score for docIdx, score in rVal.items() if docIdx in matches}
+        if rVal is None:
+            rVal = self._eval({'match_all': {}})
+        for query in clauses('must_not'):
+            matches = self._eval(query)
+            rVal = {docIdx: score for docIdx, score in rVal.items() if docIdx not in matches}
+        return rVal
+
+    def _sorted(self, matches, sort):
+        order = sorted(matches)
+        if sort is None:
+            return sorted(order, key=lambda docIdx: -matches[docIdx])
+        for spec in reversed(sort if isinstance(sort, list) else [sort]):
+            if isinstance(spec, str):
+                field, direction = spec, 'asc'
+            else:
+                (field, direction), = spec.items()
+                if isinstance(direction, dict):
+                    direction = direction.get('order', 'asc')
+            if field == '_doc':
+                continue
+            if field == '_score':
+                key = lambda docIdx: matches[docIdx]
+            else:
+                key = lambda docIdx: _path(self.movies[docIdx], field)
+            present = [docIdx for docIdx in order if key(docIdx) is not None]
+            missing = [docIdx for docIdx in order if key(docIdx) is None]
+            order = sorted(present, key=key, reverse=(direction == 'desc')) + missing
+        return order
+
+    def _hit(self, docIdx, score, source):
+        movie = self.movies[docIdx]
+        if source is False:
+            movie = None
+        elif isinstance(source, list):
+            movie = {field: movie[field] for field in source if field in movie}
+        hit = {"_index": self.index, "_type": "movie", "_id": self.ids[docIdx], "_score": score}
+        if movie is not None:
+            hit["_source"] = movie
+        return hit
+
+    def _topHits(self, docIdxs, size, sort, source=True, scores=None):
+        scores = scores or {docIdx: 1.0 for docIdx in docIdxs}
+        hits = [self._hit(docIdx, scores[docIdx], source)
+                for docIdx in self._sorted(scores, sort)[:size]]
+        return {"total": len(docIdxs), "max_score": max(scores.values(), default=None), "hits": hits}
+
+    def _aggs(self, aggs, docIdxs):
+        rVal = {}
+        for name, agg in aggs.items():
+            subAggs = agg.get('aggs', agg.get('aggregations'))
+            (kind, params), = [(kind, params) for kind, params in agg.items()
+                               if kind not in ('aggs', 'aggregations')]
+            if kind in ('stats', 'min', 'max'):
+                # The only script sent is the popularity.POPULARITY_SCRIPT port
+                if 'script' in params:
+                    values = moviePopularities([self.movies[docIdx] for docIdx in docIdxs]).tolist()
+                else:
+                    values = [_path(self.movies[docIdx], params['field']) for docIdx in docIdxs]
+                    values = [value for value in values if value is not None]
+                stats = {"count": len(values), "min": min(values, default=None),
+                         "max": max(values, default=None), "sum": sum(values),
+                         "avg": sum(values) / len(values) if values else None}
+                rVal[name] = stats if kind == 'stats' else {"value": stats[kind]}
+            elif kind == 'cardinality':
+                rVal[name] = {"value": len({_path(self.movies[docIdx], params['field']) for docIdx in docIdxs}
+                                           - {None})}
+            elif kind == 'terms':
+                byTerm = {}
+                for docIdx in docIdxs:
+                    term = _path(self.movies[docIdx], params['field'])
+                    if term is not None:
+                        byTerm.setdefault(term, []).append(docIdx)
+                include = params.get('include')
+                if isinstance(include, dict):
+                    byTerm = {term: idxs for term, idxs in byTerm.items()
+                              if zlib.crc32(str(term).encode('utf-8')) % include['num_partitions']
+                              == include['partition']}
+                terms = sorted(byTerm, key=lambda term: (-len(byTerm[term]), term))[:params.get('size', 10)]
+                buckets = []
+                for term in terms:
+                    bucket = {"key": term, "doc_count": len(byTerm[term])}
+                    if subAggs:
+                        bucket.update(self._aggs(subAggs, byTerm[term]))
+                    buckets.append(bucket)
+                rVal[name] = {"buckets": buckets}
+            elif kind == 'top_hits':
+                rVal[name] = {"hits": self._topHits(docIdxs, params.get('size', 3), params.get('sort'),
+                                                    source=params.get('_source', True))}
+            else:
+                raise ValueError("FakeElasticsearch can't run %s aggregations" % kind)
+        return rVal
+
+    def search(self, index=None, body=None, scroll=None, size=None, doc_type=None, **kwargs):
+        self._count('search')
+        body = body or {}
+        matches = self._eval(body.get('query', {'match_all': {}}))
+        if 'slice' in body:
+            matches = {docIdx: score for docIdx, score in matches.items()
+                       if docIdx % body['slice']['max'] == body['slice']['id']}
+        if size is None:
+            size = body.get('size', 10)
+        source = body.get('_source', True)
+        order = self._sorted(matches, body.get('sort'))
+        resp = {"took": 1, "timed_out": False, "_shards": SHARDS,
+                "hits": {"total": len(matches),
+                         "max_score": max(matches.values(), default=None),
+                         "hits": [self._hit(docIdx, matches[docIdx], source) for docIdx in order[:size]]}}
+        if 'aggs' in body or 'aggregations' in body:
+            resp['aggregations'] = self._aggs(body.get('aggs', body.get('aggregations')), list(matches))
+        if scroll:
+            scrollId = str(next(self.scrollIds))
+            self.scrolls[scrollId] = (order, matches, source, size, size)
+            resp['_scroll_id'] = scrollId
+        return resp
+
+    def scroll(self, scroll_id=None, body=None, scroll=None, **kwargs):
+        self._count('scroll')
+        if scroll_id is None:
+            scroll_id = body['scroll_id']
+        order, matches, source, size, pos = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (order, matches, source, size, pos + size)
+        return {"_scroll_id": scroll_id, "took": 1, "timed_out": False, "_shards": SHARDS,
+                "hits": {"total": len(matches), "max_score": None,
+                         "hits": [self._hit(docIdx, matches[docIdx], source)
+                                  for docIdx in order[pos:pos + size]]}}
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        scrollIds = scroll_id if scroll_id is not None else (body or {}).get('scroll_id', [])
+        for scrollId in (scrollIds if isinstance(scrollIds, list) else [scrollIds]):
+            self.scrolls.pop(scrollId, None)
+        return {"succeeded": True}
+
+    def msearch(self, body, index=None, **kwargs):
+        self._count('msearch')
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(index=header.get('index', index), body=search))
+            except ValueError as e:
+                responses.append({"error": {"type": "fake_error", "reason": str(e)}, "status": 400})
+        return {"took": 1, "responses": responses}
+
+
+def _name(rng, syllables=('ka', 'lo', 'ren', 'dor', 'mi', 'tha', 'vel', 'zu', 'quin', 'sar', 'bel', 'nox'),
+          parts=(2, 3)):
+    return ''.join(rng.choice(syllables) for _ in range(rng.randint(*parts)))
+
+
+def synthMovies(numDocs, collectionSize=(2, 8), overviewWords=(30, 90), seriesFraction=0.5, seed=0):
+    """ A TMDB like corpus of numDocs movies. About seriesFraction of them
+        belong to collections of collectionSize (min, max) members, which
+        share a title and a cast of recurring proper nouns. Overviews are
+        overviewWords (min, max) long, drawn Zipf like from a common
+        vocabulary with proper nouns mixed in. Titles can repeat, as
+        remakes' do, giving exact title matches"""
+    rng = random.Random(seed)
+    vocab = [_name(rng, parts=(1, 3)) for _ in range(2000)]
+    vocabWeights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    names = sorted({_name(rng).capitalize() for _ in range(max(50, numDocs // 5))})
+
+    def overview(cast):
+        words = []
+        for _ in range(rng.randint(*overviewWords)):
+            if rng.random() < 0.1:
+                words.append(rng.choice(cast))
+            else:
+                words.append(rng.choices(vocab, weights=vocabWeights)[0])
+        return ' '.join(words) + '.'
+
+    movies = []
+    collId = 0
+    while len(movies) < numDocs * seriesFraction:
+        collId += 1
+        base = ' '.join(rng.choice(names) for _ in range(rng.randint(1, 2)))
+        cast = rng.sample(names, 5)
+        for part in range(1, rng.randint(*collectionSize) + 1):
+            movies.append({"title": base if part == 1 else "%s %s" % (base, part),
+                           "overview": overview(cast + rng.sample(names, 3)),
+                           "belongs_to_collection": {"id": collId, "name": "%s Collection" % base}})
+    while len(movies) < numDocs:
+        movies.append({"title": ' '.join(rng.choice(names + vocab)
+                                         for _ in range(rng.randint(1, 4))).title(),
+                       "overview": overview(rng.sample(names, 4)),
+                       "belongs_to_collection": None})
+    movies = movies[:numDocs]
+    rng.shuffle(movies)
+    for docId, movie in enumerate(movies, 1):
+        movie['id'] = docId
+        movie['vote_count'] = int(rng.paretovariate(1.2) * 5)
+        movie['vote_average'] = round(rng.uniform(2.0, 9.5), 1)
+    return movies
@@ -0,0 +1,127 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from elasticsearch import TransportError
+from esClient import esClient, retryable, backoff, RETRY_STATUSES
+from judgments import judgmentsByQid, judgmentsFromFile, judgmentsToFile
+from instrument import esCall
+
+# Logs ranking features onto judgments. Each feature is an ES query
+# template with "{{keywords}}" placeholders, its value for a doc being the
+# doc's score for that query. All of a qid's features are searched for
+# restricted to the qid's docs, many qids per _msearch.
+#
+# The backend is anything with the client's msearch(index=, body=) shape,
+# so a fake can stand in for a cluster.
+
+FEATURE_BATCH_SIZE = 20
+MAX_IN_FLIGHT = 4
+MAX_RETRIES = 3
+
+def loadFeatureQueries(filename):
+    """ A json list of feature query templates"""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _featureQuery(template, keywords, docIds):
+    escapedKeywords = json.dumps(keywords)[1:-1]
+    query = json.loads(json.dumps(template).replace('{{keywords}}', escapedKeywords))
+    return {
+        "size": len(docIds),
+        "_source": False,
+        "query": {
+            "bool": {
+                "must": [query],
+                "filter": [{"ids": {"values": docIds}}]
+            }
+        }
+    }
+
+
+def _responseError(resp):
+    error = resp['error']
+    return TransportError(resp.get('status', 500), error.get('type') if isinstance(error, dict) else error,
+                          error)
+
+
+def _msearch(es, index, body, retries=MAX_RETRIES):
+    """ msearch, retrying timeouts and busy responses with jittered
+        exponential backoff. Queries the cluster was too busy for are
+        sent again on their own, any other error in the response is
+        raised straight away with its own status"""
+    responses = [None] * (len(body) // 2)
+    pending = list(range(len(responses)))
+    for attempt in range(retries + 1):
+        try:
+            with esCall('feature_msearch'):
+                resp = es.msearch(index=index, body=[line for query in pending
+                                                     for line in body[2 * query:2 * query + 2]])
+        except TransportError as e:
+            if attempt == retries or not retryable(e):
+                raise
+        else:
+            busy = []
+            for query, queryResp in zip(pending, resp['responses']):
+                if 'error' not in queryResp:
+                    responses[query] = queryResp
+                elif queryResp.get('status') in RETRY_STATUSES and attempt < retries:
+                    busy.append(query)
+                else:
+                    raise _responseError(queryResp)
+            pending = busy
+            if not pending:
+                return {'responses': responses}
+        time.sleep(backoff(attempt))
+
+
+def _logBatch(es, batch, featureQueries, index, retries):
+    body = []
+    for judgments in batch:
+        docIds = list(dict.fromkeys(str(judg.docId) for judg in judgments))
+        for template in featureQueries:
+            body.append({"index": index})
+            body.append(_featureQuery(template, judgments[0].keywords, docIds))
+    responses = iter(_msearch(es, index=index, body=body, retries=retries)['responses'])
+    for judgments in batch:
+        scores = [{str(hit['_id']): hit['_score'] for hit in next(responses)['hits']['hits']}
+                  for template in featureQueries]
+        for judg in judgments:
+            judg.features = [featureScores.get(str(judg.docId), 0.0) for featureScores in scores]
+
+
+def logFeatures(judgments, es, featureQueries, index='tmdb', batchSize=FEATURE_BATCH_SIZE,
+                maxInFlight=MAX_IN_FLIGHT, retries=MAX_RETRIES):
+    """ Fill in features for judgments, sending batchSize qids per
+        _msearch with at most maxInFlight requests at once. Returns
+        the judgments grouped by qid"""
+    byQid = judgmentsByQid(judgments)
+    groups = list(byQid.values())
+    batches = [groups[start:start + batchSize] for start in range(0, len(groups), batchSize)]
+    logBatch = partial(_logBatch, es, featureQueries=featureQueries, index=index, retries=retries)
+    with ThreadPoolExecutor(max_workers=maxInFlight) as executor:
+        list(executor.map(logBatch, batches))
+    return byQid
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Log ranking features onto a judgments file')
+    parser.add_argument('judgments', help='Judgments file to log features for')
+    parser.add_argument('features', help='Json list of feature query templates')
+    parser.add_argument('output', help='Judgments file to write with features')
+    parser.add_argument('--index', default='tmdb')
+    parser.add_argument('--batch-size', type=int, default=FEATURE_BATCH_SIZE,
+                        help='Queries (qids) per _msearch')
+    parser.add_argument('--in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help='Concurrent _msearch requests')
+    args = parser.parse_args()
+
+    # _msearch does the retrying, of whole requests and of queries the
+    # cluster was too busy for
+    es = esClient(retries=0)
+    byQid = logFeatures(list(judgmentsFromFile(args.judgments)), es=es,
+                        featureQueries=loadFeatureQueries(args.features), index=args.index,
+                        batchSize=args.batch_size, maxInFlight=args.in_flight)
+    judgmentsToFile(args.output, (judg for judgments in byQid.values() for judg in judgments))
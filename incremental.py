@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import hashlib
+from collStats import refreshCollections
+from judgments import Judgment, judgmentsToFile
+from negativeSampler import NegativeSampler
+from posParser import PARSE_BATCH_SIZE
+from queryCandidate import QueryCandidate
+from queryPerDoc import scanSeries, reflectBatch, phraseJudgments, qcToJudg, _batches
+from reflector import QueryClass, ReflectionMemo
+import instrument
+
+# Where the last run's state is kept between runs
+STATE_DB = 'synth_state.db'
+
+# Rows per sqlite statement in bulk reads, under its variable limit
+BULK_ROWS = 500
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS docs (docId TEXT PRIMARY KEY, seq INTEGER, title TEXT, '
+    'collId TEXT, fingerprint TEXT, live INTEGER)',
+    'CREATE INDEX IF NOT EXISTS docs_title ON docs (title)',
+    'CREATE TABLE IF NOT EXISTS candidates (phrase TEXT, docId TEXT, grade INTEGER, qp TEXT, '
+    'docTitle TEXT, queryClass INTEGER, queryScore REAL, PRIMARY KEY (phrase, docId))',
+    'CREATE INDEX IF NOT EXISTS candidates_doc ON candidates (docId)',
+    'CREATE TABLE IF NOT EXISTS queries (phrase TEXT PRIMARY KEY, qid INTEGER UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS judgments (qid INTEGER, pos INTEGER, grade INTEGER, keywords TEXT, '
+    'docId TEXT, title TEXT, PRIMARY KEY (qid, pos))',
+    'CREATE INDEX IF NOT EXISTS judgments_doc ON judgments (docId)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+]
+
+
+def movieFingerprint(movie):
+    """ Hash of the fields reflection reads from a movie's _source"""
+    return hashlib.sha1(json.dumps(movie, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _chunks(values, size=BULK_ROWS):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class IncrementalState:
+    """ What the last run reflected, kept in sqlite so the next run
+        only reflects what changed since.
+
+        Each series movie's fingerprint is kept with the query candidates
+        reflected from it, and each phrase that made a query with its qid
+        and rendered judgments. update() scans fingerprints, re-reflects
+        new and changed movies along with the members of their (old and
+        new) collections, as a movie's grades depend on its siblings, and
+        then re-renders only the phrases those reflections, or dropped
+        movies, touch. Other phrases keep their judgments and qids.
+
+        As with reflections keyed by title, of movies sharing a title
+        only the last one seen counts (is live). Negatives are only drawn
+        per query, per doc sampling depends on every phrase at once. Phrase
+        doc frequencies come from the phrase_df cache, so phrases of
+        unchanged movies aren't regraded as doc frequencies drift"""
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def _meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def _setMeta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def _select(self, sql, values):
+        """ Rows of sql, with (%s) standing in for each chunk of values"""
+        rows = []
+        for chunk in _chunks(values):
+            rows.extend(self.db.execute(sql % ','.join('?' * len(chunk)), chunk).fetchall())
+        return rows
+
+    def update(self, es, index='tmdb', doc_type='movie', slices=1, limit=None, minTopGrade=1,
+               minLen=10, perQuery=None, seed=0):
+        """ Bring the state up to date with the index, returning how
+            many (movies reflected, phrases re-rendered).
+
+            Every series movie is fingerprinted, not just the first
+            NUM_MOVIES_TO_SCAN of an unordered scan, which would miss
+            changes and have movies come and go as the scroll order
+            shifts. limit tracks only the first that many by id, scanned
+            unsliced so the window is the same each run, those falling out
+            of it count as removed"""
+        settings = [minTopGrade, minLen, perQuery, seed]
+        with instrument.stage('fingerprint'):
+            if limit is None:
+                scan = scanSeries(es, index=index, doc_type=doc_type, slices=slices)
+            else:
+                scan = scanSeries(es, index=index, doc_type=doc_type, limit=limit, ordered=True)
+            movies = dict(scan)
+            fingerprints = {docId: movieFingerprint(movie) for docId, movie in movies.items()}
+            known = {docId: (fingerprint, title, collId) for docId, fingerprint, title, collId
+                     in self.db.execute('SELECT docId, fingerprint, title, collId FROM docs')}
+        changed = [docId for docId in movies if known.get(docId, (None,))[0] != fingerprints[docId]]
+        removed = [docId for docId in known if docId not in movies]
+
+        collIds = {str(movies[docId]['belongs_to_collection']['id']) for docId in changed}
+        collIds.update(known[docId][2] for docId in changed + removed if docId in known)
+        touchedDocs = set(changed) | set(removed)
+        toReflect = [docId for docId, movie in movies.items()
+                     if docId in touchedDocs or str(movie['belongs_to_collection']['id']) in collIds]
+        titles = {movies[docId]['title'] for docId in changed}
+        titles.update(known[docId][1] for docId in changed + removed if docId in known)
+        print("%s new or changed, %s removed, reflecting %s of %s movies"
+              % (len(changed), len(removed), len(toReflect), len(movies)))
+
+        refreshCollections(es, sorted(collIds), index=index)
+        memo = ReflectionMemo()
+        with self.db:
+            wasLive = self._live(titles)
+            nextSeq = self._meta('nextSeq', 0)
+            affected = self._phrasesOf(touchedDocs | set(toReflect))
+            self._delete('candidates', removed + toReflect)
+            self._delete('docs', removed)
+            for batch in _batches(toReflect, PARSE_BATCH_SIZE):
+                reflections = reflectBatch(es=es, movies=[(docId, movies[docId]) for docId in batch],
+                                           index=index, memo=memo)
+                rows = []
+                for docId, (title, reflection) in zip(batch, reflections):
+                    if docId not in known:
+                        self.db.execute('INSERT INTO docs (docId, seq) VALUES (?, ?)', (docId, nextSeq))
+                        nextSeq += 1
+                    movie = movies[docId]
+                    self.db.execute('UPDATE docs SET title=?, collId=?, fingerprint=? WHERE docId=?',
+                                    (title, str(movie['belongs_to_collection']['id']),
+                                     fingerprints[docId], docId))
+                    for phrase, qc in reflection.queryCandidates.items():
+                        rows.append((phrase, docId, qc.asJudgment(), qc.qp, qc.docTitle,
+                                     qc.queryClass.value, qc.queryScore))
+                        affected.add(phrase)
+                self.db.executemany('INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._setMeta('nextSeq', nextSeq)
+
+            isLive = self._relive(titles)
+            flipped = set(wasLive) ^ set(isLive)
+            affected |= self._phrasesOf(flipped)
+            if self._meta('settings') != settings:
+                affected.update(phrase for phrase, in self.db.execute('SELECT DISTINCT phrase FROM candidates'))
+                affected.update(phrase for phrase, in self.db.execute('SELECT phrase FROM queries'))
+                self._setMeta('settings', settings)
+
+            with instrument.stage('render'):
+                self._render(sorted(affected), minTopGrade=minTopGrade, minLen=minLen,
+                             perQuery=perQuery, seed=seed)
+        print("Collection siblings %s" % memo)
+        return len(toReflect), len(affected)
+
+    def _delete(self, table, docIds):
+        for chunk in _chunks(docIds):
+            self.db.execute('DELETE FROM %s WHERE docId IN (%s)' % (table, ','.join('?' * len(chunk))), chunk)
+
+    def _live(self, titles):
+        return [docId for docId, in self._select('SELECT docId FROM docs WHERE live=1 AND title IN (%s)',
+                                                  titles)]
+
+    def _relive(self, titles):
+        """ Make the last seen movie of each of titles the live one"""
+        for chunk in _chunks(titles):
+            marks = ','.join('?' * len(chunk))
+            self.db.execute('UPDATE docs SET live=0 WHERE title IN (%s)' % marks, chunk)
+            self.db.execute('UPDATE docs SET live=1 WHERE seq IN (SELECT MAX(seq) FROM docs '
+                            'WHERE title IN (%s) GROUP BY title)' % marks, chunk)
+        return self._live(titles)
+
+    def _phrasesOf(self, docIds):
+        """ Phrases docIds are candidates for, or were judged for"""
+        phrases = {phrase for phrase, in self._select('SELECT phrase FROM candidates WHERE docId IN (%s)',
+                                                       docIds)}
+        phrases.update(phrase for phrase, in self._select(
+            'SELECT phrase FROM queries WHERE qid IN (SELECT qid FROM judgments WHERE docId IN (%s))',
+            docIds))
+        return phrases
+
+    def _render(self, phrases, minTopGrade, minLen, perQuery, seed):
+        """ Judge each of phrases afresh from its live candidates, new
+            queries numbered after the last qid handed out"""
+        negatives = None
+        if perQuery:
+            docs = self.db.execute('SELECT docId, title FROM docs WHERE live=1 ORDER BY seq').fetchall()
+            negatives = NegativeSampler(docs=docs, phraseFreqs={}, perQuery=perQuery, seed=seed)
+        qids = dict(self._select('SELECT phrase, qid FROM queries WHERE phrase IN (%s)', phrases))
+        nextQid = self._meta('nextQid', 0)
+        for phrase in phrases:
+            qcs = [QueryCandidate(es=None, queryPhrase=qp, docId=docId, docTitle=docTitle,
+                                  queryClass=QueryClass(queryClass), queryScore=queryScore)
+                   for qp, docId, docTitle, queryClass, queryScore in self.db.execute(
+                       'SELECT c.qp, c.docId, c.docTitle, c.queryClass, c.queryScore FROM candidates c '
+                       'JOIN docs d ON c.docId = d.docId WHERE c.phrase=? AND d.live=1 '
+                       'ORDER BY c.grade DESC, d.seq', (phrase,))]
+            qcs = phraseJudgments(phrase, qcs, minTopGrade=minTopGrade, minLen=minLen, negatives=negatives)
+            qid = qids.get(phrase)
+            if qid is not None:
+                self.db.execute('DELETE FROM judgments WHERE qid=?', (qid,))
+            if not qcs:
+                continue
+            if qid is None:
+                # A phrase keeps its qid from then on, even while it makes no query
+                qid = nextQid
+                nextQid += 1
+                self.db.execute('INSERT INTO queries (phrase, qid) VALUES (?, ?)', (phrase, qid))
+            self.db.executemany('INSERT INTO judgments VALUES (?, ?, ?, ?, ?, ?)',
+                                [(qid, pos, judg.grade, judg.keywords, str(judg.docId), judg.title)
+                                 for pos, judg in enumerate(qcToJudg(qc, qid=qid) for qc in qcs)])
+        self._setMeta('nextQid', nextQid)
+
+    def judgments(self):
+        """ Every query's judgments, grouped by qid"""
+        for qid, grade, keywords, docId, title in self.db.execute(
+                'SELECT qid, grade, keywords, docId, title FROM judgments ORDER BY qid, pos'):
+            yield Judgment(grade=grade, qid=qid, keywords=keywords, docId=docId, title=title)
+
+    def write(self, filename, **kwargs):
+        """ judgmentsToFile from the state, returns the number of queries"""
+        return judgmentsToFile(filename=filename, judgmentsList=self.judgments(), **kwargs)
+
+    def close(self):
+        self.db.close()
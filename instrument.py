@@ -0,0 +1,120 @@
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+from threading import Lock
+
+# Run wide counters of where time goes: wall and CPU time per pipeline
+# stage, count and latency histogram of ES calls by kind, and cache hit
+# rates. Each process keeps its own, pool workers send theirs back to be
+# merged with snapshot(reset=True) / merge().
+
+# Upper bounds (ms) of the ES latency histogram buckets, the last open ended
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+_lock = Lock()
+_stats = {'stages': {}, 'esCalls': {}, 'caches': {}}
+
+
+def _newEsCall():
+    return {'count': 0, 'ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+
+
+@contextmanager
+def stage(name):
+    """ Time a stage of the pipeline, stages may nest"""
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        with _lock:
+            stats = _stats['stages'].setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            stats['count'] += 1
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+
+
+@contextmanager
+def esCall(kind):
+    """ Time a request to ES of the given kind"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+        with _lock:
+            stats = _stats['esCalls'].setdefault(kind, _newEsCall())
+            stats['count'] += 1
+            stats['ms'] += ms
+            stats['buckets'][bucket] += 1
+
+
+def cacheLookup(name, hit):
+    with _lock:
+        stats = _stats['caches'].setdefault(name, {'hits': 0, 'misses': 0})
+        stats['hits' if hit else 'misses'] += 1
+
+
+def snapshot(reset=False):
+    global _stats
+    with _lock:
+        rVal = json.loads(json.dumps(_stats))
+        if reset:
+            _stats = {'stages': {}, 'esCalls': {}, 'caches': {}}
+    return rVal
+
+
+def merge(other):
+    """ Add another process's snapshot into this one's counts"""
+    with _lock:
+        for name, stats in other['stages'].items():
+            mine = _stats['stages'].setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            for key in mine:
+                mine[key] += stats[key]
+        for kind, stats in other['esCalls'].items():
+            mine = _stats['esCalls'].setdefault(kind, _newEsCall())
+            mine['count'] += stats['count']
+            mine['ms'] += stats['ms']
+            mine['buckets'] = [a + b for a, b in zip(mine['buckets'], stats['buckets'])]
+        for name, stats in other['caches'].items():
+            mine = _stats['caches'].setdefault(name, {'hits': 0, 'misses': 0})
+            mine['hits'] += stats['hits']
+            mine['misses'] += stats['misses']
+
+
+def report():
+    rVal = snapshot()
+    for stats in rVal['esCalls'].values():
+        stats['meanMs'] = stats['ms'] / stats['count'] if stats['count'] else 0.0
+        stats['histogramMs'] = {('<=%s' % bound): count for bound, count
+                                in zip(LATENCY_BUCKETS_MS + ['inf'], stats.pop('buckets'))}
+    for stats in rVal['caches'].values():
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRate'] = stats['hits'] / lookups if lookups else 0.0
+    return rVal
+
+
+def writeReport(filename):
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+@contextmanager
+def profiled(filename=None):
+    """ cProfile what runs inside, dumping stats to filename if given"""
+    if filename is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
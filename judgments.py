@@ -1,8 +1,19 @@
-import re
+import gzip
+import mmap
+import shutil
+import tempfile
+from array import array
+from os import path
+import numpy as np
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
 
 class Judgment:
     """ A judgment, ready to be serialized to
         libsvm format"""
+    __slots__ = ('grade', 'qid', 'keywords', 'title', 'docId', 'features', 'weight')
+
     def __init__(self, grade, qid, keywords, docId, title=None, weight=1):
         self.grade = grade
         self.qid = qid
@@ -28,71 +39,180 @@ class Judgment:
         return "%s\tqid:%s\t%s %s" % (self.grade, self.qid, "\t".join(featuresAsStrs), comment)
 
 
-def _queriesToHeader(qidToKwDict):
-    """ Place a comment in the header
-        to map query ids to keywords """
-    rVal = ""
-    for qid, kws in qidToKwDict.items():
-        rVal += "# qid:%s: %s" % (qid, kws[0])
-        rVal += "*%s\n" % kws[1]
-    rVal += "\n"
-    return rVal
+def _queryToHeader(qid, keywords, weight):
+    """ Header comment mapping a query id to keywords """
+    return "# qid:%s: %s*%s\n" % (qid, keywords, weight)
 
 
-def _queriesFromHeader(lines):
+def _queryFromHeader(line):
     """ Parses out mapping between, query id and user keywords
-        from header comments, ie:
-        # qid:523: First Blood
-        returns dict mapping all query ids to search keywords"""
-    # Regex can be debugged here:
-    # http://www.regexpal.com/?fam=96564
-    regex = re.compile('#\sqid:(\d+?):\s+?(.*)')
-    rVal = {}
-    for line in lines:
-        if line[0] != '#':
-            break
-        m = re.match(regex, line)
-        if m:
-            keywordAndWeight = m.group(2).split('*')
-            keyword = keywordAndWeight[0]
-            weight = 1
-            if len(keywordAndWeight) > 1:
-                weight = int(keywordAndWeight[1])
-            rVal[int(m.group(1))] = (keyword, weight)
+        from a header comment, ie:
+        # qid:523: First Blood*2
+        returns (qid, keywords, weight)"""
+    qid, _, keywordAndWeight = line[len(b'# qid:'):].partition(b':')
+    keyword, star, weight = keywordAndWeight.strip().decode('utf-8').rpartition('*')
+    if not star:
+        return int(qid), weight, 1
+    return int(qid), keyword, int(weight)
 
-    return rVal
 
-def _judgmentsFromBody(lines):
-    """ Parses out judgment/grade, query id, and docId in line such as:
-         4  qid:523   # a01  Grade for Rambo for query Foo
-        <judgment> qid:<queryid> # docId <rest of comment ignored...)"""
-    # Regex can be debugged here:
-    # http://www.regexpal.com/?fam=96565
-    regex = re.compile('^(\d)\s+qid:(\d+)\s+#\s+(\w+).*')
-    for line in lines:
-        print(line)
-        m = re.match(regex, line)
-        if m:
-            print("%s,%s,%s" % (m.group(1), m.group(2), m.group(3)))
-            yield int(m.group(1)), int(m.group(2)), m.group(3)
+def _judgmentFromBody(line):
+    """ Parses out judgment/grade, query id, features, docId and title
+        in a line such as written by Judgment.toLibSvm:
+         12  qid:523  1:0.5  2:3.2 # a01 (Rambo)  rambo
+        <judgment> qid:<queryid> <n:value...> # docId (title) <keywords>"""
+    content, _, comment = line.partition(b'#')
+    fields = content.split()
+    if len(fields) < 2 or not fields[1].startswith(b'qid:'):
+        return None
+    features = []
+    for feature in fields[2:]:
+        idx, _, value = feature.partition(b':')
+        features.append((int(idx) - 1, float(value)))
+    docIdAndRest = comment.split(None, 1)
+    docId = docIdAndRest[0].decode('utf-8') if docIdAndRest else None
+    title = None
+    if len(docIdAndRest) > 1 and docIdAndRest[1].startswith(b'('):
+        titleEnd = docIdAndRest[1].rfind(b')\t')
+        if titleEnd > 0:
+            title = docIdAndRest[1][1:titleEnd].decode('utf-8')
+    return int(fields[0]), int(fields[1][4:]), docId, title, features
+
+
+def _judgmentLines(filename, useMmap=False):
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            yield from f
+    elif useMmap:
+        if path.getsize(filename) == 0:
+            return
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter(mm.readline, b'')
+    else:
+        with open(filename, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            yield from f
+
+
+def _judgmentRows(filename, queries, useMmap=False):
+    """ One pass over a judgments file, filling queries with
+        qid -> (keywords, weight) from the header and yielding
+        (grade, qid, docId, title, features) for each judgment"""
+    for line in _judgmentLines(filename, useMmap=useMmap):
+        if line.startswith(b'#'):
+            if line.startswith(b'# qid:'):
+                qid, keywords, weight = _queryFromHeader(line)
+                queries[qid] = (keywords, weight)
+            continue
+        row = _judgmentFromBody(line)
+        if row is not None:
+            yield row
+
 
+def _denseFeatures(features):
+    dense = [0.0] * (max(idx for idx, value in features) + 1) if features else []
+    for idx, value in features:
+        dense[idx] = value
+    return dense
 
-def judgmentsFromFile(filename):
-    with open(filename) as f:
-        qidToKeywords = _queriesFromHeader(f)
-    with open(filename) as f:
-        for grade, qid, docId in _judgmentsFromBody(f):
-            yield Judgment(grade=grade, qid=qid, keywords=qidToKeywords[qid][0], weight=qidToKeywords[qid][1], docId=docId)
 
+def judgmentsFromFile(filename, useMmap=False):
+    """ Judgments read back from a file written by judgmentsToFile
+        (or gzipped), optionally reading through an mmap"""
+    queries = {}
+    for grade, qid, docId, title, features in _judgmentRows(filename, queries, useMmap=useMmap):
+        keywords, weight = queries.get(qid, (None, 1))
+        judgment = Judgment(grade=grade, qid=qid, keywords=keywords, weight=weight,
+                            docId=docId, title=title)
+        judgment.features = _denseFeatures(features)
+        yield judgment
 
-def judgmentsToFile(filename, judgmentsList):
-    judgToQid = judgmentsByQid(judgmentsList) #Pretty hideosly slow stuff
-    fileHeader = _queriesToHeader({qid: (judgs[0].keywords, judgs[0].weight) for qid, judgs in judgToQid.items()})
-    judgByQid = sorted(judgmentsList, key=lambda j: j.qid)
-    with open(filename, 'w+') as f:
-        f.write(fileHeader)
-        for judg in judgByQid:
-            f.write(judg.toLibSvm() + '\n')
+
+def judgmentColumnsFromFile(filename, useMmap=False):
+    """ Bulk read of a judgments file into columns. Returns a dict with
+        grade, qid and weight int arrays, docId and title lists, keywords
+        mapping qid -> keywords and features in CSR form: the 0 based
+        featureIndex and featureValue of row i lie between featureOffsets[i]
+        and featureOffsets[i+1]"""
+    queries = {}
+    cols = {'grade': array('i'), 'qid': array('i'), 'weight': array('i'),
+            'docId': [], 'title': [],
+            'featureIndex': array('i'), 'featureValue': array('d'), 'featureOffsets': array('q', [0])}
+    for grade, qid, docId, title, features in _judgmentRows(filename, queries, useMmap=useMmap):
+        cols['grade'].append(grade)
+        cols['qid'].append(qid)
+        cols['weight'].append(queries.get(qid, (None, 1))[1])
+        cols['docId'].append(docId)
+        cols['title'].append(title)
+        for idx, value in features:
+            cols['featureIndex'].append(idx)
+            cols['featureValue'].append(value)
+        cols['featureOffsets'].append(len(cols['featureIndex']))
+    cols['keywords'] = {qid: keywords for qid, (keywords, weight) in queries.items()}
+    return cols
+
+
+def judgmentsToFile(filename, judgmentsList, compress=None, expandWeights=False):
+    """ Write judgments, which may be any iterable with each qid's
+        judgments together, in a single pass. Bodies are spooled to a
+        temp file while the (one line per query) header accumulates,
+        so memory doesn't grow with the number of judgments.
+
+        With expandWeights, a query of weight n is written n times, the
+        extra copies under new qids after the last real one. Copies are
+        only made as text while writing, each weighted query's lines are
+        spooled once and replayed per copy.
+
+        Gzips when compress is set, or by default if filename ends in .gz.
+        Returns the number of queries written"""
+    if compress is None:
+        compress = filename.endswith('.gz')
+    header = []
+    seenQids = set()
+    lastQid = None
+    aliases = [] # (qid, keywords, weight, number of lines) of each weighted query
+    spoolDir = path.dirname(path.abspath(filename))
+    with tempfile.TemporaryFile('w+', dir=spoolDir, buffering=WRITE_BUFFER_SIZE) as body, \
+         tempfile.TemporaryFile('w+', dir=spoolDir, buffering=WRITE_BUFFER_SIZE) as weighted:
+        for judg in judgmentsList:
+            if judg.qid != lastQid:
+                if judg.qid in seenQids:
+                    raise ValueError("Judgments for qid %s are not grouped together" % judg.qid)
+                seenQids.add(judg.qid)
+                lastQid = judg.qid
+                header.append(_queryToHeader(judg.qid, judg.keywords, judg.weight))
+                if expandWeights and judg.weight > 1:
+                    aliases.append([judg.qid, judg.keywords, judg.weight, 0])
+            line = judg.toLibSvm() + '\n'
+            body.write(line)
+            if aliases and aliases[-1][0] == judg.qid:
+                weighted.write(line)
+                aliases[-1][3] += 1
+
+        nextQid = max(seenQids, default=-1) + 1
+        for qid, keywords, weight, numLines in aliases:
+            for copy in range(weight - 1):
+                header.append(_queryToHeader(nextQid + copy, keywords, weight))
+            nextQid += weight - 1
+
+        body.seek(0)
+        weighted.seek(0)
+        if compress:
+            f = gzip.open(filename, 'wt')
+        else:
+            f = open(filename, 'w', buffering=WRITE_BUFFER_SIZE)
+        with f:
+            f.writelines(header)
+            f.write('\n')
+            shutil.copyfileobj(body, f, WRITE_BUFFER_SIZE)
+            nextQid = max(seenQids, default=-1) + 1
+            for qid, keywords, weight, numLines in aliases:
+                lines = [weighted.readline() for _ in range(numLines)]
+                qidField = "\tqid:%s\t" % qid
+                for copy in range(weight - 1):
+                    aliasField = "\tqid:%s\t" % (nextQid + copy)
+                    f.writelines(line.replace(qidField, aliasField, 1) for line in lines)
+                nextQid += weight - 1
+    return len(header)
 
 
 
@@ -108,23 +228,152 @@ def judgmentsByQid(judgments):
 
 
 def duplicateJudgmentsByWeight(judgmentsByQid):
+    """ Copies each query of weight n under n-1 new qids after the last
+        one. Copies share the originals' features. To write a weighted
+        file, judgmentsToFile(expandWeights=True) avoids the copies"""
     rVal = {}
-    from copy import deepcopy
-    maxQid = 0
-    for qid, judgments in judgmentsByQid.items():
-        maxQid = qid
-    print("maxQid %s" % maxQid)
+    nextQid = max(judgmentsByQid, default=-1) + 1
     for qid, judgments in judgmentsByQid.items():
         rVal[qid] = judgments
-        if (judgments[0].weight > 1):
-            for i in range(judgments[0].weight - 1):
-                rVal[maxQid] = deepcopy(judgments)
-                for judg in judgments:
-                    judg.qid = maxQid
-                maxQid += 1
+        for i in range(judgments[0].weight - 1):
+            rVal[nextQid] = [_aliasJudgment(judg, nextQid) for judg in judgments]
+            nextQid += 1
+    return rVal
 
 
-    return rVal
+def _aliasJudgment(judgment, qid):
+    alias = Judgment(grade=judgment.grade, qid=qid, keywords=judgment.keywords,
+                     docId=judgment.docId, title=judgment.title, weight=judgment.weight)
+    alias.features = judgment.features
+    return alias
+
+
+class JudgmentSet:
+    """ Many judgments stored by column rather than as Judgment objects.
+
+        grade, qid, weight and doc (an index into the interned docIds and
+        titles) are int32 arrays, keywords maps each qid to its keywords
+        and features is a dense (judgments x features) matrix. Indexing or
+        iterating gives back Judgment views for compatibility"""
+
+    def __init__(self, grade, qid, weight, doc, docIds, titles, keywords, features=None):
+        self.grade = np.asarray(grade, dtype=np.int32)
+        self.qid = np.asarray(qid, dtype=np.int32)
+        self.weight = np.asarray(weight, dtype=np.int32)
+        self.doc = np.asarray(doc, dtype=np.int32)
+        self.docIds = docIds
+        self.titles = titles
+        self.keywords = keywords
+        if features is None:
+            features = np.zeros((len(self.grade), 0))
+        self.features = features
+
+    @classmethod
+    def fromJudgments(cls, judgments):
+        grade, qid, weight, doc = array('i'), array('i'), array('i'), array('i')
+        docIds, titles, features = [], [], []
+        keywords = {}
+        docIdxs = {}
+        for judgment in judgments:
+            docIdx = docIdxs.get(judgment.docId)
+            if docIdx is None:
+                docIdx = docIdxs[judgment.docId] = len(docIds)
+                docIds.append(judgment.docId)
+                titles.append(judgment.title)
+            grade.append(judgment.grade)
+            qid.append(judgment.qid)
+            weight.append(judgment.weight)
+            doc.append(docIdx)
+            keywords.setdefault(judgment.qid, judgment.keywords)
+            features.append(judgment.features)
+        numFeatures = max((len(f) for f in features), default=0)
+        featureMatrix = np.zeros((len(features), numFeatures))
+        for row, rowFeatures in enumerate(features):
+            featureMatrix[row, :len(rowFeatures)] = rowFeatures
+        return cls(grade, qid, weight, doc, docIds, titles, keywords, featureMatrix)
+
+    @classmethod
+    def fromColumns(cls, cols):
+        """ From the dict judgmentColumnsFromFile returns"""
+        docIdxs = {}
+        docIds, titles = [], []
+        doc = array('i')
+        for docId, title in zip(cols['docId'], cols['title']):
+            docIdx = docIdxs.get(docId)
+            if docIdx is None:
+                docIdx = docIdxs[docId] = len(docIds)
+                docIds.append(docId)
+                titles.append(title)
+            doc.append(docIdx)
+        offsets = np.frombuffer(cols['featureOffsets'], dtype=np.int64)
+        featureIndex = np.frombuffer(cols['featureIndex'], dtype=np.int32)
+        numFeatures = int(featureIndex.max()) + 1 if len(featureIndex) else 0
+        features = np.zeros((len(cols['grade']), numFeatures))
+        rows = np.repeat(np.arange(len(cols['grade'])), np.diff(offsets))
+        features[rows, featureIndex] = np.frombuffer(cols['featureValue'], dtype=np.float64)
+        return cls(cols['grade'], cols['qid'], cols['weight'], doc,
+                   docIds, titles, cols['keywords'], features)
+
+    @classmethod
+    def fromFile(cls, filename, useMmap=False):
+        return cls.fromColumns(judgmentColumnsFromFile(filename, useMmap=useMmap))
+
+    def __len__(self):
+        return len(self.grade)
+
+    def __getitem__(self, idx):
+        qid = int(self.qid[idx])
+        judgment = Judgment(grade=int(self.grade[idx]), qid=qid,
+                            keywords=self.keywords.get(qid),
+                            docId=self.docIds[self.doc[idx]], title=self.titles[self.doc[idx]],
+                            weight=int(self.weight[idx]))
+        judgment.features = self.features[idx].tolist()
+        return judgment
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def groupByQid(self):
+        """ Yields (qid, row indices) for each qid in qid order"""
+        order = np.argsort(self.qid, kind='stable')
+        bounds = np.flatnonzero(np.diff(self.qid[order])) + 1
+        for rows in np.split(order, bounds):
+            if len(rows):
+                yield int(self.qid[rows[0]]), rows
+
+    def filter(self, mask):
+        """ The judgments selected by a boolean mask (or row indices),
+            sharing this set's doc and keyword tables"""
+        return JudgmentSet(self.grade[mask], self.qid[mask], self.weight[mask], self.doc[mask],
+                           self.docIds, self.titles, self.keywords, self.features[mask])
+
+    def toFile(self, filename, compress=None, expandWeights=False):
+        """ Write as libsvm through judgmentsToFile"""
+        if np.all(np.diff(self.qid) >= 0):
+            judgments = iter(self)
+        else:
+            judgments = (self[idx] for qid, rows in self.groupByQid() for idx in rows)
+        return judgmentsToFile(filename, judgments, compress=compress, expandWeights=expandWeights)
+
+    def saveNpz(self, filename):
+        keywordQids = sorted(self.keywords)
+        np.savez_compressed(filename, grade=self.grade, qid=self.qid, weight=self.weight,
+                            doc=self.doc, features=self.features,
+                            docIds=np.array(self.docIds, dtype=str),
+                            titles=np.array([title or '' for title in self.titles], dtype=str),
+                            keywordQids=np.array(keywordQids, dtype=np.int32),
+                            keywords=np.array([self.keywords[qid] or '' for qid in keywordQids], dtype=str))
+
+    @classmethod
+    def loadNpz(cls, filename):
+        with np.load(filename) as npz:
+            return cls(npz['grade'], npz['qid'], npz['weight'], npz['doc'],
+                       npz['docIds'].tolist(),
+                       [title or None for title in npz['titles'].tolist()],
+                       dict(zip(npz['keywordQids'].tolist(), npz['keywords'].tolist())),
+                       npz['features'])
+
 
 if __name__ == "__main__":
     from sys import argv
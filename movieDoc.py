@@ -1,3 +1,7 @@
+from instrument import esCall
+
+# The parts of a movie's _source reflection reads
+MOVIE_FIELDS = ['id', 'title', 'overview', 'belongs_to_collection', 'vote_count', 'vote_average']
 
 def byTitlePhrase(es, titleSearch="star trek", index='tmdb'):
     allQ = {
@@ -21,3 +25,35 @@ def byCollPhrase(es, collNameSearch="star trek", index='tmdb'):
     resp = es.search(index=index, body=allQ)
     for doc in resp['hits']['hits']:
         yield doc['_source']
+
+
+def exactTitleQuery(title, docId):
+    """ Other movies with a 100% mm title match"""
+    return {
+        "size": 10,
+        "query": {
+            "bool": {
+                "must": [
+                    {"match_phrase": {
+                        "title_sent": {
+                            "query": "SENTINEL_BEGIN %s SENTINEL_END" % title,
+                            "boost": 10000.0}}},
+                ],
+                "must_not": [
+                    {"match": {"_id": docId}}
+                ]
+            }
+        }
+    }
+
+
+def exactTitleLookup(es, title, docId, index='tmdb'):
+    resp = exactTitleLookup.prefetched.pop(str(docId), None)
+    if resp is None:
+        with esCall('exact_title'):
+            resp = es.search(index=index, body=exactTitleQuery(title, docId))
+    return resp
+
+# Responses fetched ahead of time (ie by the async pipeline), keyed
+# by docId and used up by the next lookup of that doc
+exactTitleLookup.prefetched = {}
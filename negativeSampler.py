@@ -0,0 +1,83 @@
+import random
+from math import log2
+from queryCandidate import QueryCandidate
+from reflector import QueryClass
+
+class NegativeSampler:
+    """ Unrelated (grade 0) judgments for a query, drawn within a fixed
+        budget instead of crossing every phrase with every doc.
+
+        docs is a list of (docId, docTitle) to draw from and phraseFreqs
+        maps each phrase to how many docs reflect it.
+
+        perQuery draws up to that many docs for each query. perDoc has
+        every doc draw that many phrases, round robin over phrase doc
+        frequency strata if stratify is set so rare phrases get their
+        share. Draws that turn out to be positives are dropped.
+
+        Per query draws are seeded by phrase, so a query's negatives don't
+        depend on the order queries are asked for"""
+
+    def __init__(self, docs, phraseFreqs, perQuery=None, perDoc=None, stratify=False, seed=0):
+        self.docs = docs
+        self.perQuery = perQuery
+        self.seed = seed
+        self.docsByPhrase = {}
+        if perDoc:
+            self._sampleByDoc(phraseFreqs, perDoc=perDoc, stratify=stratify)
+
+    def _sampleByDoc(self, phraseFreqs, perDoc, stratify):
+        rng = random.Random("%s:perDoc" % self.seed)
+        if stratify:
+            strata = {}
+            for phrase, freq in phraseFreqs.items():
+                strata.setdefault(int(log2(max(freq, 1))), []).append(phrase)
+            strata = [sorted(strata[stratum]) for stratum in sorted(strata)]
+        else:
+            # Sorted, so draws don't depend on the order phrases were inverted in
+            strata = [sorted(phraseFreqs)]
+        if not strata or not strata[0]:
+            return
+        for docIdx in range(len(self.docs)):
+            offset = rng.randrange(len(strata))
+            for draw in range(perDoc):
+                stratum = strata[(offset + draw) % len(strata)]
+                phrase = stratum[rng.randrange(len(stratum))]
+                self.docsByPhrase.setdefault(phrase, []).append(docIdx)
+
+    def _sampleForQuery(self, phrase, positiveDocIds):
+        rng = random.Random("%s:%s" % (self.seed, phrase))
+        if self.perQuery * 2 > len(self.docs):
+            # Budget is most of the corpus, shuffle rather than reject
+            available = [docIdx for docIdx, (docId, docTitle) in enumerate(self.docs)
+                         if docId not in positiveDocIds]
+            rng.shuffle(available)
+            return available[:self.perQuery]
+        drawn = set()
+        chosen = []
+        budget = min(self.perQuery, len(self.docs) - len(positiveDocIds))
+        while len(chosen) < budget and len(drawn) < len(self.docs):
+            docIdx = rng.randrange(len(self.docs))
+            if docIdx in drawn:
+                continue
+            drawn.add(docIdx)
+            if self.docs[docIdx][0] not in positiveDocIds:
+                chosen.append(docIdx)
+        return chosen
+
+    def negatives(self, phrase, positiveDocIds):
+        """ QueryCandidates for docs sampled as unrelated to phrase,
+            in doc order, skipping any in positiveDocIds"""
+        chosen = set()
+        if self.perQuery:
+            chosen.update(self._sampleForQuery(phrase, positiveDocIds))
+        chosen.update(docIdx for docIdx in self.docsByPhrase.get(phrase, ())
+                      if self.docs[docIdx][0] not in positiveDocIds)
+        rVal = []
+        for docIdx in sorted(chosen):
+            docId, docTitle = self.docs[docIdx]
+            rVal.append(QueryCandidate(es=None, queryClass=QueryClass.UNRELATED_TERMS,
+                                       queryScore=0.0,
+                                       queryPhrase=phrase,
+                                       docId=docId, docTitle=docTitle))
+        return rVal
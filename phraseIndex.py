@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import numpy as np
+from popularity import moviePopularities, popRange
+
+# Offline stand in for the match_phrase queries phraseStats sends: a
+# positional index over the text_all.en content of a local TMDB json dump,
+# persisted as .npy files and memory mapped back, so opening one is
+# instant and worker processes share its pages.
+#
+# analyze() approximates the english analyzer behind text_all.en: standard
+# ish tokens, lowercased, possessives and english stopwords dropped (keeping
+# their positions) and only the plural step of the porter stemmer. Dfs are
+# close to, not always exactly, what the cluster answers.
+
+# Fields copied into text_all, each value a position gap from the last
+TEXT_ALL_FIELDS = ['title', 'overview']
+POSITION_GAP = 100
+
+STOPWORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into',
+             'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then',
+             'there', 'these', 'they', 'this', 'to', 'was', 'will', 'with'}
+
+ARRAYS = ['docIds', 'popularity', 'voteAverage', 'termBytes', 'termOffsets',
+          'termPostings', 'postingDocs', 'postingPositions', 'positions']
+
+_token = re.compile(r"\w+(?:'\w+)*")
+
+def _stem(term):
+    if term.endswith('sses'):
+        return term[:-2]
+    if term.endswith('ies'):
+        return term[:-2]
+    if term.endswith('s') and not term.endswith('ss') and len(term) > 2:
+        return term[:-1]
+    return term
+
+
+def analyze(text, start=0):
+    """ (position, term) of each indexed token of text"""
+    for pos, match in enumerate(_token.finditer(text.lower()), start):
+        term = match.group()
+        if term.endswith("'s"):
+            term = term[:-2]
+        if term not in STOPWORDS:
+            yield pos, _stem(term)
+
+
+def _movieTerms(movie, fields):
+    start = 0
+    for field in fields:
+        value = movie.get(field)
+        if isinstance(value, str):
+            yield from analyze(value, start=start)
+            start += len(_token.findall(value.lower())) + POSITION_GAP
+
+
+def loadDump(filename):
+    """ Movies of a TMDB json dump, either a list of movies or
+        an object of them keyed by id"""
+    with open(filename) as f:
+        movies = json.load(f)
+    if isinstance(movies, dict):
+        movies = list(movies.values())
+    return movies
+
+
+def buildPhraseIndex(movies, path, fields=TEXT_ALL_FIELDS):
+    """ Write the positional index of movies to the directory path"""
+    postings = {}
+    for docIdx, movie in enumerate(movies):
+        for pos, term in _movieTerms(movie, fields):
+            postings.setdefault(term, {}).setdefault(docIdx, []).append(pos)
+    terms = sorted(postings, key=lambda term: term.encode('utf-8'))
+    termBytes = [term.encode('utf-8') for term in terms]
+
+    arrays = {
+        'docIds': np.array([int(movie['id']) for movie in movies], dtype=np.int64),
+        'popularity': moviePopularities(movies),
+        # Missing votes sort last, as ES sorts missing values
+        'voteAverage': np.array([-np.inf if movie.get('vote_average') is None else movie['vote_average']
+                                 for movie in movies], dtype=np.float64),
+        'termBytes': np.frombuffer(b''.join(termBytes), dtype=np.uint8),
+        'termOffsets': np.cumsum([0] + [len(term) for term in termBytes], dtype=np.int64),
+        'termPostings': np.cumsum([0] + [len(postings[term]) for term in terms], dtype=np.int64)
+    }
+    docs = []
+    positionCounts = [0]
+    positions = []
+    for term in terms:
+        for docIdx in sorted(postings[term]):
+            docs.append(docIdx)
+            positionCounts.append(len(postings[term][docIdx]))
+            positions.extend(postings[term][docIdx])
+    arrays['postingDocs'] = np.array(docs, dtype=np.int32)
+    arrays['postingPositions'] = np.cumsum(positionCounts, dtype=np.int64)
+    arrays['positions'] = np.array(positions, dtype=np.int32)
+
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(path, name + '.npy'), arrays[name])
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'fields': fields, 'positionGap': POSITION_GAP,
+                   'numDocs': len(movies), 'numTerms': len(terms)}, f)
+    return PhraseIndex(path)
+
+
+class PhraseIndex:
+    """ A positional index written by buildPhraseIndex, memory mapped"""
+
+    def __init__(self, path):
+        self.path = path
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.docIds)
+
+    def _term(self, termId):
+        return bytes(self.termBytes[self.termOffsets[termId]:self.termOffsets[termId + 1]])
+
+    def termId(self, term):
+        """ Binary search of the sorted terms, None if not indexed"""
+        term = term.encode('utf-8')
+        lo, hi = 0, len(self.termOffsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.termOffsets) - 1 and self._term(lo) == term:
+            return lo
+        return None
+
+    def _docs(self, termId):
+        return self.postingDocs[self.termPostings[termId]:self.termPostings[termId + 1]]
+
+    def _positions(self, termId, docIdx):
+        posting = self.termPostings[termId] + np.searchsorted(self._docs(termId), docIdx)
+        return self.positions[self.postingPositions[posting]:self.postingPositions[posting + 1]]
+
+    def phraseDocs(self, phrase):
+        """ Indices of the docs matching phrase as a match_phrase"""
+        analyzed = list(analyze(phrase))
+        if not analyzed:
+            return np.array([], dtype=np.int32)
+        termIds = [self.termId(term) for pos, term in analyzed]
+        if None in termIds:
+            return np.array([], dtype=np.int32)
+        docs = self._docs(termIds[0])
+        for termId in termIds[1:]:
+            docs = np.intersect1d(docs, self._docs(termId), assume_unique=True)
+        if len(termIds) == 1:
+            return np.asarray(docs)
+        offsets = [pos - analyzed[0][0] for pos, term in analyzed]
+        matched = []
+        for docIdx in docs:
+            starts = set(self._positions(termIds[0], docIdx).tolist())
+            for termId, offset in zip(termIds[1:], offsets[1:]):
+                starts &= {pos - offset for pos in self._positions(termId, docIdx).tolist()}
+                if not starts:
+                    break
+            if starts:
+                matched.append(docIdx)
+        return np.array(matched, dtype=np.int32)
+
+    def phraseStats(self, phrase, popAggs=False, maxHits=None):
+        """ (phraseFreq, minPop, maxPop) as phraseStats answers from ES.
+            Without popAggs the range covers only the maxHits docs
+            with the highest vote_average, as the hits query does"""
+        docs = self.phraseDocs(phrase)
+        if not popAggs and maxHits is not None and len(docs) > maxHits:
+            top = np.argsort(-self.voteAverage[docs], kind='stable')[:maxHits]
+            pops = self.popularity[docs[top]]
+        else:
+            pops = self.popularity[docs]
+        minPop, maxPop = popRange(pops)
+        return len(docs), minPop, maxPop
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Build, or query, an offline phrase index of a TMDB json dump')
+    parser.add_argument('index', help='Directory of the index')
+    parser.add_argument('--build', default=None, help='TMDB json dump to (re)build the index from')
+    parser.add_argument('--aggs', action='store_true',
+                        help='Popularity range over all matches, not the top hits')
+    parser.add_argument('phrases', nargs='*', help='Phrases to print stats of')
+    args = parser.parse_args()
+
+    from phraseStats import PHRASE_HITS
+    if args.build:
+        index = buildPhraseIndex(loadDump(args.build), args.index)
+        print("Indexed %s docs, %s terms" % (len(index), index.meta['numTerms']))
+    else:
+        index = PhraseIndex(args.index)
+    for phrase in args.phrases:
+        pf, minPop, maxPop = index.phraseStats(phrase, popAggs=args.aggs, maxHits=PHRASE_HITS)
+        print("%s => freq %s minPop %s maxPop %s" % (phrase, pf, minPop, maxPop))
@@ -1,12 +1,45 @@
-import os
-import atexit
-import json
-from popularity import moviePopRange
-from elasticsearch import Elasticsearch
-
-def phraseStats(phrase, es, index='tmdb'):
-    termsQ = {
-        "size": 5000,
+from cacheStore import CacheStore, LOOKUP_TTL
+from instrument import esCall, cacheLookup
+from popularity import moviePopRange, popRangeAggs, popRangeFromAggs, POPULARITY_FIELDS
+from phraseIndex import PhraseIndex
+from esClient import esClient
+
+MSEARCH_BATCH_SIZE = 50
+
+# Top hits (by vote_average) the popularity range is taken over
+PHRASE_HITS = 5000
+
+# Compute popularity ranges with server side aggregations rather
+# than pulling back and scoring the top 5000 hits
+POP_AGGS = False
+
+# A phraseIndex.PhraseIndex answering phrase stats locally rather than
+# ES, set with setOfflineIndex. Its answers skip the phrase df cache,
+# which holds only what the cluster said
+OFFLINE_INDEX = None
+
+def setOfflineIndex(path):
+    """ Answer phrase stats from the offline index at path,
+        or from ES again if path is None"""
+    global OFFLINE_INDEX
+    OFFLINE_INDEX = None if path is None else PhraseIndex(path)
+    return OFFLINE_INDEX
+
+
+def _phraseQuery(phrase, popAggs=False):
+    if popAggs:
+        return {
+            "size": 0,
+            "query": {
+                "match_phrase": {
+                    "text_all.en": phrase
+                }
+            },
+            "aggs": popRangeAggs()
+        }
+    return {
+        "size": PHRASE_HITS,
+        "_source": POPULARITY_FIELDS,
         "sort": [
             {"vote_average": "desc"}
         ],
@@ -16,38 +49,109 @@ def phraseStats(phrase, es, index='tmdb'):
             }
         }
     }
-    resp = es.search(index=index, body=termsQ)
 
+
+def _phraseStatsFromResp(resp):
     phraseFreq = resp['hits']['total'];
 
-    minPop, maxPop = moviePopRange(resp['hits']['hits'])
+    if 'aggregations' in resp:
+        minPop, maxPop = popRangeFromAggs(resp['aggregations'])
+    else:
+        minPop, maxPop = moviePopRange(resp['hits']['hits'])
     return phraseFreq, minPop, maxPop
 
 
+def phraseStats(phrase, es, index='tmdb', popAggs=None):
+    if popAggs is None:
+        popAggs = POP_AGGS
+    if OFFLINE_INDEX is not None:
+        return OFFLINE_INDEX.phraseStats(phrase, popAggs=popAggs, maxHits=PHRASE_HITS)
+    with esCall('phrase_df'):
+        resp = es.search(index=index, body=_phraseQuery(phrase, popAggs=popAggs))
+    return _phraseStatsFromResp(resp)
+
+
+def phraseStatsMany(phrases, es, index='tmdb', batchSize=MSEARCH_BATCH_SIZE, popAggs=None):
+    """ Same as phraseStats, but for a list of phrases, sending
+        batchSize phrase queries per _msearch round trip. Returns
+        a list of (phraseFreq, minPop, maxPop) in phrase order"""
+    if popAggs is None:
+        popAggs = POP_AGGS
+    if OFFLINE_INDEX is not None:
+        return [OFFLINE_INDEX.phraseStats(phrase, popAggs=popAggs, maxHits=PHRASE_HITS)
+                for phrase in phrases]
+    rVal = []
+    for start in range(0, len(phrases), batchSize):
+        batch = phrases[start:start + batchSize]
+        body = []
+        for phrase in batch:
+            body.append({"index": index})
+            body.append(_phraseQuery(phrase, popAggs=popAggs))
+        with esCall('phrase_df_msearch'):
+            resp = es.msearch(body=body)
+        for phrase, phraseResp in zip(batch, resp['responses']):
+            if 'error' in phraseResp:
+                # Retry on its own so the real failure surfaces
+                rVal.append(phraseStats(phrase=phrase, es=es, index=index, popAggs=popAggs))
+            else:
+                rVal.append(_phraseStatsFromResp(phraseResp))
+    return rVal
+
+
+def phraseCacheKey(text, popAggs=None):
+    """ phrase_df cache key of text, per mode as hits and aggs
+        popularity ranges needn't agree"""
+    if popAggs is None:
+        popAggs = POP_AGGS
+    return '%s|%s' % (text.lower(), bool(popAggs))
 
-def phraseDocFreq(text, es):
-    lookupText = text.lower()
-    if True: # lookupText not in phraseDocFreq.cache:
-        pf, minPop, maxPop = phraseStats(phrase=text, es=es)
+
+def phraseDocFreq(text, es, popAggs=None):
+    if OFFLINE_INDEX is not None:
+        return phraseStats(phrase=text, es=es, popAggs=popAggs)
+    lookupText = phraseCacheKey(text, popAggs=popAggs)
+    cached = phraseDocFreq.cache.get(lookupText)
+    cacheLookup('phrase_df', cached is not None)
+    if cached is None:
+        pf, minPop, maxPop = phraseStats(phrase=text, es=es, popAggs=popAggs)
         phraseDocFreq.cache[lookupText] = [pf, minPop, maxPop]
         return pf, minPop, maxPop
     else:
-        return phraseDocFreq.cache[lookupText][0], \
-               phraseDocFreq.cache[lookupText][1], \
-               phraseDocFreq.cache[lookupText][2]
-phraseDocFreq.cache={}
-if os.path.exists('df_cache.json'):
-    with open('df_cache.json') as f:
-        phraseDocFreq.cache = json.load(f)
-
-@atexit.register
-def saveCache():
-    with open('df_cache.json', 'w') as f:
-        print('writing pf cache')
-        json.dump(phraseDocFreq.cache, f)
+        return cached[0], cached[1], cached[2]
+phraseDocFreq.cache = CacheStore(table='phrase_df', ttl=LOOKUP_TTL)
+
+
+def phraseDocFreqMany(texts, es, batchSize=MSEARCH_BATCH_SIZE, popAggs=None):
+    """ Batched phraseDocFreq, returns dict of each text
+        to its (docFreq, minPop, maxPop)"""
+    if OFFLINE_INDEX is not None:
+        return {text: phraseStats(phrase=text, es=es, popAggs=popAggs) for text in dict.fromkeys(texts)}
+    rVal = {}
+    misses = []
+    for text in dict.fromkeys(texts):
+        cached = phraseDocFreq.cache.get(phraseCacheKey(text, popAggs=popAggs))
+        cacheLookup('phrase_df', cached is not None)
+        if cached is None:
+            misses.append(text)
+        else:
+            rVal[text] = (cached[0], cached[1], cached[2])
+    for text, stats in zip(misses, phraseStatsMany(phrases=misses, es=es, batchSize=batchSize,
+                                                   popAggs=popAggs)):
+        phraseDocFreq.cache[phraseCacheKey(text, popAggs=popAggs)] = list(stats)
+        rVal[text] = stats
+    return rVal
 
 if __name__ == "__main__":
-    es = Elasticsearch()
-    from sys import argv
-    pf, minPop, maxPop = phraseStats(es=es, phrase=argv[1])
-    print("%s => freq %s minPop %s maxPop %s" % (argv[1], pf, minPop, maxPop))
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Doc frequency and popularity range of a phrase')
+    parser.add_argument('phrase')
+    parser.add_argument('--aggs', action='store_true',
+                        help='Popularity range over all matches, not the top hits')
+    parser.add_argument('--offline-index', default=None,
+                        help='Answer from this phraseIndex directory rather than ES')
+    args = parser.parse_args()
+
+    es = esClient()
+    setOfflineIndex(args.offline_index)
+    pf, minPop, maxPop = phraseStats(es=es, phrase=args.phrase, popAggs=args.aggs)
+    print("%s => freq %s minPop %s maxPop %s" % (args.phrase, pf, minPop, maxPop))
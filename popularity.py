@@ -1,6 +1,16 @@
-from elasticsearch import Elasticsearch
+import numpy as np
+from esClient import esClient
+from esClient import restartingScan
 from movieDoc import byTitlePhrase
 
+# vote_count tiers of moviePopularity, counts below each bound
+# scaling vote_average to that tier's max popularity
+VOTE_COUNT_TIERS = [20, 90, 200]
+TIER_MAX_POPS = [3.0, 5.0, 7.0, 10.0]
+
+# The _source fields popularity is computed from
+POPULARITY_FIELDS = ['vote_count', 'vote_average']
+
 def moviePopularity(movie):
     if 'vote_count' not in movie:
         return 1.0
@@ -23,26 +33,155 @@ def moviePopularity(movie):
     return popularity
 
 
-def moviePopRange(hits):
+# Painless port of moviePopularity for server side aggregations. vote_average
+# is round tripped through its float string so a float mapped field gives
+# back the same double Python parsed from _source
+POPULARITY_SCRIPT = """
+if (doc['vote_count'].size() == 0 || doc['vote_average'].size() == 0) {
+    return 1.0;
+}
+long voteCnt = doc['vote_count'].value;
+double maxPop = 10.0;
+if (voteCnt < 20) {
+    maxPop = 3.0;
+} else if (voteCnt < 90) {
+    maxPop = 5.0;
+} else if (voteCnt < 200) {
+    maxPop = 7.0;
+}
+double voteAvg = Double.parseDouble(Float.toString((float) doc['vote_average'].value));
+return maxPop * (voteAvg / 10.0);
+"""
+
+
+def popRangeAggs():
+    """ Aggregations computing the popularity range server side,
+        send with size 0 and read back with popRangeFromAggs"""
+    return {
+        "popularity": {
+            "stats": {
+                "script": {
+                    "lang": "painless",
+                    "source": POPULARITY_SCRIPT
+                }
+            }
+        }
+    }
+
+
+def _popRange(lowest, highest):
     maxPop = 0; minPop = 11
-    maxPopDoc = minPopDoc = None
-    for doc in hits:
-        pop = moviePopularity(doc['_source'])
-        if pop > maxPop:
-            maxPop = pop
-            maxPopDoc = doc['_source']
-        if pop < minPop:
-            minPop = pop
-            minPopDoc = doc['_source']
+    if highest is not None and highest > maxPop:
+        maxPop = highest
+    if lowest is not None and lowest < minPop:
+        minPop = lowest
     if minPop == maxPop:
         maxPop += 0.001
 
     return minPop, maxPop
 
 
+def popRangeFromAggs(aggs):
+    """ Same (minPop, maxPop) moviePopRange gives over the matched docs"""
+    stats = aggs['popularity']
+    return _popRange(stats['min'], stats['max'])
+
+
+def popRange(pops):
+    """ (minPop, maxPop) of an array of popularities"""
+    if len(pops) == 0:
+        return _popRange(None, None)
+    return _popRange(float(pops.min()), float(pops.max()))
+
+
+def popularities(voteCounts, voteAverages):
+    """ moviePopularity over arrays of vote_count and vote_average,
+        nan for either one missing giving 1.0"""
+    voteCounts = np.asarray(voteCounts, dtype=np.float64)
+    voteAverages = np.asarray(voteAverages, dtype=np.float64)
+    maxPops = np.array(TIER_MAX_POPS)[np.searchsorted(VOTE_COUNT_TIERS, voteCounts, side='right')]
+    pops = maxPops * (voteAverages / 10.0)
+    pops[np.isnan(voteCounts) | np.isnan(voteAverages)] = 1.0
+    return pops
+
+
+def moviePopularities(movies):
+    """ moviePopularity of each of a list of movies, as an array"""
+    voteCounts = [np.nan if movie.get('vote_count') is None else movie['vote_count'] for movie in movies]
+    voteAverages = [np.nan if movie.get('vote_average') is None else movie['vote_average']
+                    for movie in movies]
+    return popularities(voteCounts, voteAverages)
+
+
+class PopularityTable:
+    """ Precomputed popularity of every doc in the corpus, gathered
+        by docId rather than recomputed from each hit's _source"""
+
+    def __init__(self, docIds, pops):
+        order = np.argsort(docIds, kind='stable')
+        self.docIds = np.asarray(docIds, dtype=np.int64)[order]
+        self.pops = np.asarray(pops, dtype=np.float64)[order]
+
+    @classmethod
+    def fromMovies(cls, movies):
+        return cls([int(movie['id']) for movie in movies], moviePopularities(movies))
+
+    @classmethod
+    def fromPhraseIndex(cls, index):
+        return cls(index.docIds, index.popularity)
+
+    @classmethod
+    def fromScan(cls, es, index='tmdb'):
+        """ Scan the whole index for just the popularity fields"""
+        hits = list(restartingScan(es, scroll='5m', index=index,
+                                   query={"_source": POPULARITY_FIELDS, "query": {"match_all": {}}}))
+        return cls([int(hit['_id']) for hit in hits], moviePopularities([hit['_source'] for hit in hits]))
+
+    def __len__(self):
+        return len(self.docIds)
+
+    def gather(self, docIds):
+        """ (popularities, found) of docIds, found masking those
+            in the table"""
+        docIds = np.asarray(docIds, dtype=np.int64)
+        if len(self.docIds) == 0:
+            return np.zeros(len(docIds)), np.zeros(len(docIds), dtype=bool)
+        idxs = np.minimum(np.searchsorted(self.docIds, docIds), len(self.docIds) - 1)
+        return self.pops[idxs], self.docIds[idxs] == docIds
+
+
+# A PopularityTable for moviePopRange to gather from, see setPopularityTable
+POPULARITY_TABLE = None
+
+def setPopularityTable(table):
+    global POPULARITY_TABLE
+    POPULARITY_TABLE = table
+    return table
+
+
+def hitPopularities(hits):
+    """ moviePopularity of each hit, gathered by _id from the
+        popularity table where it has them"""
+    if POPULARITY_TABLE is None:
+        return moviePopularities([hit['_source'] for hit in hits])
+    try:
+        pops, found = POPULARITY_TABLE.gather([int(hit['_id']) for hit in hits])
+    except ValueError:
+        # Ids the table can't hold
+        return moviePopularities([hit['_source'] for hit in hits])
+    if not found.all():
+        missing = np.flatnonzero(~found)
+        pops[missing] = moviePopularities([hits[idx]['_source'] for idx in missing])
+    return pops
+
+
+def moviePopRange(hits):
+    return popRange(hitPopularities(hits))
+
+
 
 if __name__ == "__main__":
-    es = Elasticsearch()
+    es = esClient()
     from sys import argv
     for movie in byTitlePhrase(titleSearch=argv[1], es=es):
         pop = moviePopularity(movie)
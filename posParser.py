@@ -1,6 +1,85 @@
-import spacy
+import hashlib
+from threading import Lock
+from cacheStore import CacheStore
+from instrument import stage, cacheLookup
+
+# spaCy model overviews are parsed with, loaded on first use by getNlp
+NLP_MODEL = 'en'
+
+# Noun chunks need the tagger and parser, nothing else
+UNUSED_PIPES = ['ner']
+
+PARSE_BATCH_SIZE = 64
+
+# Look extractions up by overview content before parsing, see createMany
+USE_EXTRACTION_CACHE = True
+EXTRACTION_LRU_SIZE = 100000
+
+# Bump when what PhraseExtractor extracts changes, so extractions
+# cached before aren't reused
+EXTRACTION_VERSION = 1
+
+_nlp = None
+_nlpLock = Lock()
+_modelKey = None
+
+def configure(model=None, unusedPipes=None):
+    """ Choose the model, and pipeline components left out of it,
+        dropping any model already loaded"""
+    global NLP_MODEL, UNUSED_PIPES, _nlp, _modelKey
+    with _nlpLock:
+        if model is not None:
+            NLP_MODEL = model
+        if unusedPipes is not None:
+            UNUSED_PIPES = list(unusedPipes)
+        _nlp = None
+        _modelKey = None
+
+
+def getNlp():
+    """ The spaCy model, loaded (once, even across threads) on first call"""
+    global _nlp
+    if _nlp is None:
+        with _nlpLock:
+            if _nlp is None:
+                import spacy
+                with stage('nlp_load'):
+                    _nlp = spacy.load(NLP_MODEL, disable=UNUSED_PIPES)
+    return _nlp
+
+
+def warmUp(model=None, unusedPipes=None):
+    """ Load the model ahead of the first extraction, ie as a pool
+        initializer, so each worker pays for it once and up front"""
+    if model is not None or unusedPipes is not None:
+        configure(model=model, unusedPipes=unusedPipes)
+    getNlp()('Warm up.')
+
+
+def modelKey():
+    """ The model, its version, spaCy's version and the pipes left
+        out, found without loading the model if it's an installed package"""
+    global _modelKey
+    if _modelKey is None:
+        import spacy
+        version = None
+        try:
+            from spacy.util import get_package_version
+            version = get_package_version(NLP_MODEL)
+        except ImportError:
+            pass
+        if version is None:
+            # A shortcut link or path, only the loaded model knows
+            version = getNlp().meta.get('version')
+        _modelKey = "%s:%s:%s:%s:%s" % (NLP_MODEL, version, spacy.__version__,
+                                        ','.join(sorted(UNUSED_PIPES)), EXTRACTION_VERSION)
+    return _modelKey
+
+
+def extractionKey(text):
+    """ Content address of text's extraction by the current model"""
+    return hashlib.sha1(("%s\n%s" % (modelKey(), text)).encode('utf-8')).hexdigest()
 
-nlp = spacy.load('en')
 
 class NullPhraseExtractor:
 
@@ -13,30 +92,70 @@ class PhraseExtractor:
 
     def create(text):
         if isinstance(text, str):
-            return PhraseExtractor(text)
+            return PhraseExtractor.createMany([text])[0]
         return NullPhraseExtractor()
 
 
-    def __init__(self, text):
+    def createMany(texts, batchSize=PARSE_BATCH_SIZE):
+        """ create for a list of texts. Extractions of texts seen before
+            (by the same model) come from PhraseExtractor.cache in one
+            bulk read, the rest are parsed in batches through nlp.pipe
+            and cached"""
+        texts = list(texts)
+        unique = list(dict.fromkeys(text for text in texts if isinstance(text, str)))
+        extracted = {}
+        if USE_EXTRACTION_CACHE and unique:
+            keys = {text: extractionKey(text) for text in unique}
+            cached = PhraseExtractor.cache.getMany(keys.values(), touch=True)
+            for text in unique:
+                cacheLookup('extraction', keys[text] in cached)
+                if keys[text] in cached:
+                    extracted[text] = PhraseExtractor.fromCache(cached[keys[text]])
+        misses = [text for text in unique if text not in extracted]
+        if misses:
+            with stage('parse'):
+                for text, doc in zip(misses, getNlp().pipe(misses, batch_size=batchSize)):
+                    extracted[text] = PhraseExtractor(text, doc=doc)
+            if USE_EXTRACTION_CACHE:
+                PhraseExtractor.cache.putMany((keys[text], extracted[text].toCache()) for text in misses)
+        return [extracted[text] if isinstance(text, str) else NullPhraseExtractor() for text in texts]
+
+
+    def fromCache(cached):
+        extractor = PhraseExtractor.__new__(PhraseExtractor)
+        extractor.nPhrases = cached['nPhrases']
+        extractor.propNouns = set(cached['propNouns'])
+        return extractor
+
+
+    def toCache(self):
+        return {'nPhrases': self.nPhrases, 'propNouns': sorted(self.propNouns)}
+
+
+    def __init__(self, text, doc=None):
         try:
-            self.bodyTextNlp = nlp(text)
-            self.nPhrases = [str(np) for np in self.bodyTextNlp.noun_chunks]
-            # nouns = self.contigPosTokSet(nPhrases=nPhrases, nlp=nlp, pos='NOUN')
-            self.propNouns = self._contigPosTokSet(nPhrases=self.nPhrases, nlp=nlp, pos='PROPN')
+            if doc is None:
+                with stage('parse'):
+                    doc = getNlp()(text)
+            nounChunks = list(doc.noun_chunks)
+            self.nPhrases = [str(np) for np in nounChunks]
+            # nouns = self.contigPosTokSet(nPhrases=nounChunks, pos='NOUN')
+            self.propNouns = self._contigPosTokSet(nPhrases=nounChunks, pos='PROPN')
         except TypeError as e:
             print(e)
             import pdb; pdb.set_trace()
 
-    def _posTokStream(self, np, nlp, pos='PROPN'):
-        for token in nlp(np):
+    def _posTokStream(self, np, pos='PROPN'):
+        # np is a span of the already tagged doc
+        for token in np:
             if token.pos_ == pos:
                 yield str(token)
             else:
                 yield -1
 
-    def _posToks(self, np, nlp, pos='PROPN'):
+    def _posToks(self, np, pos='PROPN'):
         propN = []
-        for tok in self._posTokStream(np, nlp, pos=pos):
+        for tok in self._posTokStream(np, pos=pos):
             if tok == -1:
                 if propN:
                     yield propN
@@ -46,11 +165,13 @@ class PhraseExtractor:
         if propN:
             yield propN
 
-    def _contigPosTokSet(self, nPhrases, nlp, pos='PROPN'):
+    def _contigPosTokSet(self, nPhrases, pos='PROPN'):
         tokSet = set()
         for np in nPhrases:
-            tokSet = tokSet.union([' '.join(pn) for pn in self._posToks(np=np, nlp=nlp, pos=pos)])
+            tokSet = tokSet.union([' '.join(pn) for pn in self._posToks(np=np, pos=pos)])
         if ' ' in tokSet:
             tokSet.remove(' ')
         return tokSet
 
+# Extractions keyed by extractionKey, shared across runs
+PhraseExtractor.cache = CacheStore(table='extractions', lruSize=EXTRACTION_LRU_SIZE)
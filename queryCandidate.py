@@ -1,19 +1,85 @@
 
+class InternTable:
+    """ Run wide table giving each distinct value a small int id,
+        so candidates hold an id rather than their own copy of a
+        phrase or doc. Ids are only good within one process, and
+        until the table is cleared"""
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value):
+        try:
+            return self.ids[value]
+        except KeyError:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+            return len(self.values) - 1
+
+    def __getitem__(self, valueId):
+        return self.values[valueId]
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        self.ids.clear()
+        self.values.clear()
+
+# Query phrases candidates are for, by phrase id
+PHRASES = InternTable()
+
+# (docId, docTitle) of docs candidates are for, by doc id
+DOCS = InternTable()
+
+
+def resetTables():
+    """ Empty PHRASES and DOCS, once no candidates from before are
+        left to look their ids up"""
+    PHRASES.clear()
+    DOCS.clear()
+
+
 # Assemble all noun phrases into queryCandidates
 class QueryCandidate:
+    __slots__ = ('phraseId', 'docIdx', 'queryClass', 'queryScore', 'tf', 'tfidf')
+
     def __init__(self, es, queryPhrase, docId, docTitle,
                  queryClass, # A queryClass corresponds to a type of match, with lower
                              # going to more important types of matches
                  queryScore  # A queryScore is a priority-specific scoring system
                              # for arbitrating within this class
                  ):
-        self.qp = queryPhrase
-        self.docId = docId
-        self.docTitle = docTitle
+        self.phraseId = PHRASES.id(queryPhrase)
+        self.docIdx = DOCS.id((docId, docTitle))
         self.queryScore = queryScore
         self.queryClass = queryClass
         self.tf = self.tfidf = 0
 
+    @property
+    def qp(self):
+        return PHRASES[self.phraseId]
+
+    @property
+    def docId(self):
+        return DOCS[self.docIdx][0]
+
+    @property
+    def docTitle(self):
+        return DOCS[self.docIdx][1]
+
+    def __getstate__(self):
+        # Ids don't mean anything in another process, so
+        # cross as strings and intern again on the other side
+        return (self.qp, self.docId, self.docTitle, self.queryClass, self.queryScore, self.tf, self.tfidf)
+
+    def __setstate__(self, state):
+        qp, docId, docTitle, self.queryClass, self.queryScore, self.tf, self.tfidf = state
+        self.phraseId = PHRASES.id(qp)
+        self.docIdx = DOCS.id((docId, docTitle))
+
     def addOccurence(self, times=1):
         self.phraseFreq += times
         #if updatedConfidence and updatedConfidence > self.confidence:
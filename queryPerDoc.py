@@ -1,14 +1,32 @@
-from reflector import Reflector
-from elasticsearch.helpers import scan
-from elasticsearch import Elasticsearch
+from reflector import Reflector, ReflectionMemo
+from collStats import collectionLookup, prefetchCollections
+from cacheStore import LOOKUP_TTL
+import posParser
+from posParser import PhraseExtractor, PARSE_BATCH_SIZE
+from esClient import esClient, restartingScan
 from itertools import islice
+from multiprocessing import Pool
+from queue import Queue, Full
+from threading import Event, Thread
 from judgments import Judgment, judgmentsToFile
+from negativeSampler import NegativeSampler
+from queryCandidate import QueryCandidate, PHRASES
+from movieDoc import MOVIE_FIELDS
+import phraseStats
+import popularity
+import instrument
 
 NUM_MOVIES_TO_SCAN=1000
 
-INCLUDE_NEGATIVE = 1.0
-if NUM_MOVIES_TO_SCAN > 5000:
-    INCLUDE_NEGATIVE = 0.5
+# Negative (unrelated) judgments sampled per query
+NEGATIVES_PER_QUERY = 50
+
+# Hits each slice of a sliced scan may read ahead
+SLICE_READ_AHEAD = 1000
+
+# Seconds a slice's thread waits on its full queue before checking
+# whether the scan was stopped
+SLICE_POLL = 0.5
 
 def seriesMovie(movie):
     return 'title' in movie and \
@@ -17,48 +35,227 @@ def seriesMovie(movie):
             isinstance(movie['title'], str) and\
            'belongs_to_collection' in movie and movie['belongs_to_collection'] is not None
 
-def reflectSeries(es, index='tmdb', doc_type='movie'):
+def seriesScanQuery(sliceId=0, slices=1, ordered=False):
+    """ seriesMovie, as far as ES can filter for it, fetching only
+        the fields reflection uses, sorted by id if ordered"""
+    query = {
+        "_source": MOVIE_FIELDS,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"exists": {"field": "belongs_to_collection.id"}},
+                    {"exists": {"field": "title"}},
+                    {"exists": {"field": "overview"}}
+                ]
+            }
+        }
+    }
+    if slices > 1:
+        query["slice"] = {"id": sliceId, "max": slices}
+    if ordered:
+        query["sort"] = [{"id": "asc"}]
+    return query
+
+
+def _offer(queue, item, stop):
+    """ Put item on queue, unless stop is set while it's full"""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=SLICE_POLL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _scanSlice(es, index, doc_type, sliceId, slices, ordered, hits, stop):
+    sliceHits = restartingScan(es, scroll='30m', index=index, doc_type=doc_type,
+                               query=seriesScanQuery(sliceId, slices, ordered), preserve_order=ordered)
+    try:
+        for hit in sliceHits:
+            if not _offer(hits, hit, stop):
+                return
+        _offer(hits, None, stop)
+    except Exception as e:
+        _offer(hits, e, stop)
+    finally:
+        # Closing the scan clears its scroll, also when stopped early
+        sliceHits.close()
+
+
+def slicedScan(es, slices, index='tmdb', doc_type='movie', ordered=False):
+    """ Scan with each of slices pulled in parallel by its own thread,
+        reading ahead into a queue. Hits are taken from the slices in
+        turn, so every slice keeps moving and the order is the same
+        from run to run. Closing this early stops the threads and
+        clears their scrolls"""
+    stop = Event()
+    queues = []
+    try:
+        for sliceId in range(slices):
+            hits = Queue(maxsize=SLICE_READ_AHEAD)
+            Thread(target=_scanSlice, daemon=True,
+                   args=(es, index, doc_type, sliceId, slices, ordered, hits, stop)).start()
+            queues.append(hits)
+        while queues:
+            for hits in list(queues):
+                hit = hits.get()
+                if hit is None:
+                    queues.remove(hits)
+                elif isinstance(hit, Exception):
+                    raise hit
+                else:
+                    yield hit
+    finally:
+        stop.set()
+
+
+def scanSeries(es, index='tmdb', doc_type='movie', slices=1, limit=None, ordered=False):
+    """ Yield (docId, movie) for the scanned movies part of a series,
+        of the first limit scanned if given. ordered scans in id order
+        (within each slice), so a limit reads the same movies each time"""
+    if slices > 1:
+        hits = slicedScan(es, slices=slices, index=index, doc_type=doc_type, ordered=ordered)
+    else:
+        hits = restartingScan(es, scroll='30m', index=index, doc_type=doc_type,
+                              query=seriesScanQuery(ordered=ordered), preserve_order=ordered)
+    try:
+        for hit in islice(hits, limit):
+            movie = hit['_source']
+            # Movies part of a series generate the best training data
+            if seriesMovie(movie):
+                yield hit['_id'], movie
+    finally:
+        hits.close()
+
+
+def reflectMovie(es, docId, movie, index='tmdb', phrases=None, collPhrases=None, memo=None):
+    title = movie['title']
+    print("-- %s --" % title)
+    with instrument.stage('reflect'):
+        return title, Reflector(es=es, docTitle=title, docId=docId, doc=movie, index=index,
+                                phrases=phrases, collPhrases=collPhrases, memo=memo)
+
+
+def reflectBatch(es, movies, index='tmdb', memo=None):
+    """ Reflect a list of (docId, movie), parsing all their
+        overviews in one batch"""
+    phrases = PhraseExtractor.createMany([movie['overview'] for docId, movie in movies])
+    return [reflectMovie(es=es, docId=docId, movie=movie, index=index, phrases=moviePhrases, memo=memo)
+            for (docId, movie), moviePhrases in zip(movies, phrases)]
+
+
+def _batches(iterable, size):
+    iterable = iter(iterable)
+    batch = list(islice(iterable, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterable, size))
+
+
+def setLookupTtl(ttl):
+    """ Reuse cached phrase doc frequencies and collections for ttl
+        seconds, None for ever"""
+    phraseStats.phraseDocFreq.cache.ttl = ttl
+    collectionLookup.cache.ttl = ttl
+
+
+# Per worker process state, set up once by _initWorker
+_worker = {}
+
+def _initWorker(index, collIndex, offlineIndex=None, popTable=None, nlpModel=None, unusedPipes=None,
+                useExtractionCache=True, lookupTtl=LOOKUP_TTL):
+    collectionLookup.index = collIndex
+    setLookupTtl(lookupTtl)
+    posParser.USE_EXTRACTION_CACHE = useExtractionCache
+    phraseStats.setOfflineIndex(offlineIndex)
+    popularity.setPopularityTable(popTable)
+    posParser.warmUp(model=nlpModel, unusedPipes=unusedPipes)
+    _worker['es'] = esClient()
+    _worker['index'] = index
+    _worker['memo'] = ReflectionMemo()
+
+
+def _reflectInWorker(movies):
+    memo = _worker['memo']
+    built, reused = memo.built, memo.reused
+    batch = reflectBatch(es=_worker['es'], movies=movies, index=_worker['index'], memo=memo)
+    return batch, memo.built - built, memo.reused - reused, instrument.snapshot(reset=True)
+
+
+def reflectSeries(es, index='tmdb', doc_type='movie', workers=1, memo=None, slices=1):
     """ Series provide the best reflections, so we'll limit our scope
-        to those. After all this is training data!"""
-    reflections = {}
-    for hit in islice(scan(es, scroll='30m', index=index, doc_type=doc_type, query={"query": {"match_all": {}}}),NUM_MOVIES_TO_SCAN):
-        movie = hit['_source']
-        docId = hit['_id']
-        # Movies part of a series generate the best training data
-        if seriesMovie(movie):
-            title = movie['title']
-            print("-- %s --" % title)
-            reflections[title] = Reflector(es=es, docTitle=title, docId=docId, doc=movie, index='tmdb')
-    return reflections
+        to those. After all this is training data!
+
+        Returns a dict of title to reflection, see iterReflectSeries
+        for the details"""
+    return dict(iterReflectSeries(es, index=index, doc_type=doc_type, workers=workers,
+                                  memo=memo, slices=slices))
+
+
+def iterReflectSeries(es, index='tmdb', doc_type='movie', workers=1, memo=None, slices=1):
+    """ Yield (title, reflection) for each series movie scanned, so
+        callers needn't hold every reflection at once
+
+        With workers > 1 reflections are built in a process pool, each
+        worker with its own ES client and spaCy model. Results come
+        back in scan order, so the output matches the sequential path.
+
+        Collection siblings are reflected once per run (or per worker)
+        through memo, whose counts tell how many rebuilds were avoided.
+
+        slices > 1 scans with that many sliced scrolls in parallel"""
+    if memo is None:
+        memo = ReflectionMemo()
+    offlineIndex = phraseStats.OFFLINE_INDEX.path if phraseStats.OFFLINE_INDEX is not None else None
+    batches = _batches(scanSeries(es, index=index, doc_type=doc_type, slices=slices,
+                                  limit=NUM_MOVIES_TO_SCAN),
+                       PARSE_BATCH_SIZE)
+    if workers > 1:
+        with Pool(processes=workers, initializer=_initWorker,
+                  initargs=(index, collectionLookup.index, offlineIndex, popularity.POPULARITY_TABLE,
+                            posParser.NLP_MODEL, posParser.UNUSED_PIPES,
+                            posParser.USE_EXTRACTION_CACHE, collectionLookup.cache.ttl)) as pool:
+            for batch, built, reused, stats in pool.imap(_reflectInWorker, batches):
+                memo.built += built
+                memo.reused += reused
+                instrument.merge(stats)
+                yield from batch
+    else:
+        for batch in batches:
+            yield from reflectBatch(es=es, movies=batch, index=index, memo=memo)
+    print("Collection siblings %s" % memo)
 
 
 def invertReflections(reflections):
     """ Take synthetic per-query keywords and turn them into
         dictionary oriented"""
-    qcsByKeyword = {}
+    with instrument.stage('invert'):
+        return _invertReflections(reflections)
+
+
+def _invertReflections(reflections):
+    # Grouped by phrase id, cheaper to hash than the phrase
+    qcsByPhraseId = {}
     for title, ref in reflections.items():
-        for phrase, qc in ref.queryCandidates.items():
-            if phrase in qcsByKeyword:
-                qcsByKeyword[phrase].append(qc)
+        for qc in ref.queryCandidates.values():
+            if qc.phraseId in qcsByPhraseId:
+                qcsByPhraseId[qc.phraseId].append(qc)
             else:
-                qcsByKeyword[phrase] = [qc]
+                qcsByPhraseId[qc.phraseId] = [qc]
 
-    for phrase, qcs in qcsByKeyword.items():
-        qcs.sort(key=lambda qc: qc.asJudgment(), reverse=True)
+    qcsByKeyword = {}
+    for phraseId, qcs in qcsByPhraseId.items():
+        qcs.sort(key=QueryCandidate.asJudgment, reverse=True)
+        qcsByKeyword[PHRASES[phraseId]] = qcs
     return qcsByKeyword
 
-def insertNegativeJudgments(reflections):
-    from random import random
-    allNp = set()
-    for title, ref in reflections.items():
-        for phrase, qc in ref.queryCandidates.items():
-            allNp.add(qc.qp)
-
-    # Apply each qc to every other qc, add as a negative judgment if not mentioned
-    for title, ref in reflections.items():
-        for np in allNp:
-            if random() < INCLUDE_NEGATIVE:
-                ref.addNegativeJudgment(np)
+def negativeSampler(reflections, inverted, **kwargs):
+    """ A NegativeSampler drawing from the reflected docs and phrases,
+        to pass to toJudgList"""
+    docs = [(ref.docId, ref.docTitle) for ref in reflections.values()]
+    phraseFreqs = {phrase: len(qcs) for phrase, qcs in inverted.items()}
+    return NegativeSampler(docs=docs, phraseFreqs=phraseFreqs, **kwargs)
 
 
 def qcToJudg(qc, qid):
@@ -74,25 +271,159 @@ def qcToJudg(qc, qid):
 
 
 
-def toJudgList(inverted, minTopGrade=1, minLen=10):
-    judgList = []
+def iterJudgments(inverted, minTopGrade=1, minLen=10, negatives=None):
+    """ Judgments for each phrase with enough, and good enough, candidates,
+        generated grouped by qid. Unrelated docs drawn from the negatives
+        sampler are added to each phrase as it's assembled, and count
+        toward minLen.
+
+        inverted is invertReflections' dict, or anything else with its
+        items(), like a spillInvert.SpilledInversion being merged"""
     qid=0
     for phrase, qcs in inverted.items():
-        if len(qcs) >= minLen and qcs[0].asJudgment() >= minTopGrade:
+        qcs = phraseJudgments(phrase, qcs, minTopGrade=minTopGrade, minLen=minLen, negatives=negatives)
+        if qcs:
             for qc in qcs:
-                judg = qcToJudg(qc, qid=qid)
-                judgList.append(judg)
+                yield qcToJudg(qc, qid=qid)
             qid += 1
-    return judgList, (qid+1)
+
+
+def phraseJudgments(phrase, qcs, minTopGrade=1, minLen=10, negatives=None):
+    """ A phrase's candidates, best graded first, with its negatives
+        added, or None if they don't make a query"""
+    if negatives is not None and qcs and qcs[0].asJudgment() >= minTopGrade:
+        qcs = qcs + negatives.negatives(phrase, {qc.docId for qc in qcs})
+    if qcs and len(qcs) >= minLen and qcs[0].asJudgment() >= minTopGrade:
+        return qcs
+    return None
+
+
+def toJudgList(inverted, minTopGrade=1, minLen=10, negatives=None):
+    judgList = list(iterJudgments(inverted, minTopGrade=minTopGrade, minLen=minLen,
+                                  negatives=negatives))
+    numQueries = judgList[-1].qid + 1 if judgList else 0
+    return judgList, (numQueries+1)
 
 
 
 if __name__ == "__main__":
-    es=Elasticsearch()
-    reflections = reflectSeries(es)
-    insertNegativeJudgments(reflections=reflections)
-    inverted = invertReflections(reflections)
-    judgList, numQueries = toJudgList(inverted)
+    import logging
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Synthesize judgments from movies in a series')
+    parser.add_argument('--output', default='synth_judg.txt',
+                        help='Judgments file to write, gzipped if it ends in .gz')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Reflect movies in a pool of this many processes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for negative judgment sampling')
+    parser.add_argument('--neg-per-query', type=int, default=NEGATIVES_PER_QUERY,
+                        help='Unrelated docs sampled as negatives for each query')
+    parser.add_argument('--neg-per-doc', type=int, default=0,
+                        help='Unrelated phrases sampled as negatives for each doc')
+    parser.add_argument('--neg-stratify', action='store_true',
+                        help='Spread per doc negatives evenly over phrase doc frequencies')
+    parser.add_argument('--scan-slices', type=int, default=1,
+                        help='Scan series movies with this many parallel sliced scrolls')
+    parser.add_argument('--no-prefetch', dest='prefetch', action='store_false',
+                        help='Look collections up per movie rather than prefetching them all')
+    parser.add_argument('--cache-ttl', type=float, default=LOOKUP_TTL,
+                        help='Seconds to reuse cached phrase doc frequencies and collections for, '
+                             '0 to look everything up afresh')
+    parser.add_argument('--offline-index', default=None,
+                        help='Answer phrase doc frequencies from this phraseIndex directory, not ES')
+    parser.add_argument('--popularity-table', action='store_true',
+                        help='Scan every doc\'s popularity up front, rather than scoring each hit')
+    parser.add_argument('--spill-dir', default=None,
+                        help='Invert reflections through sorted runs spilled under this directory, '
+                             'for corpora too big to invert in memory')
+    parser.add_argument('--spill-run-size', type=int, default=None,
+                        help='Candidates per spilled run')
+    parser.add_argument('--incremental', default=None, metavar='STATE_DB',
+                        help='Only reflect movies changed since the run that left this state file, '
+                             're-judging just the phrases they touch')
+    parser.add_argument('--incremental-limit', type=int, default=None,
+                        help='Track only the first this many series movies by id in --incremental '
+                             'mode, rather than all of them')
+    parser.add_argument('--nlp-model', default=posParser.NLP_MODEL,
+                        help='spaCy model to parse overviews with')
+    parser.add_argument('--nlp-disable', nargs='*', default=posParser.UNUSED_PIPES,
+                        help='spaCy pipeline components to leave out')
+    parser.add_argument('--no-extraction-cache', dest='extractionCache', action='store_false',
+                        help='Parse every overview, rather than reusing extractions cached by content')
+    parser.add_argument('--async', dest='useAsync', action='store_true',
+                        help='Reflect with the asyncio pipeline on an AsyncElasticsearch client')
+    parser.add_argument('--in-flight', type=int, default=32,
+                        help='Movies being reflected at once in --async mode')
+    parser.add_argument('--max-requests', type=int, default=16,
+                        help='Outstanding ES requests allowed in --async mode')
+    parser.add_argument('--report', default='synth_judg_report.json',
+                        help='Where to write the JSON timing, ES call and cache report')
+    parser.add_argument('--profile', default=None,
+                        help='cProfile the run, dumping stats to this file')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='Log level, ie DEBUG to see each reflection')
+    args = parser.parse_args()
+    if args.incremental and (args.useAsync or args.spill_dir or args.workers > 1 or not args.prefetch
+                             or args.neg_per_doc or args.neg_stratify):
+        parser.error('--incremental reflects in this process, looks up just the collections it needs and '
+                     'draws negatives per query only, so takes none of --async, --spill-dir, --workers, '
+                     '--no-prefetch, --neg-per-doc or --neg-stratify')
+    if args.incremental_limit is not None and not args.incremental:
+        parser.error('--incremental-limit needs --incremental')
+    logging.basicConfig(level=args.log_level)
+
+    with instrument.profiled(args.profile), instrument.stage('total'):
+        es = esClient()
+        posParser.configure(model=args.nlp_model, unusedPipes=args.nlp_disable)
+        posParser.USE_EXTRACTION_CACHE = args.extractionCache
+        setLookupTtl(args.cache_ttl)
+        phraseStats.setOfflineIndex(args.offline_index)
+        if phraseStats.OFFLINE_INDEX is not None:
+            popularity.setPopularityTable(popularity.PopularityTable.fromPhraseIndex(phraseStats.OFFLINE_INDEX))
+        elif args.popularity_table:
+            with instrument.stage('popularity_table'):
+                popularity.setPopularityTable(popularity.PopularityTable.fromScan(es))
+        if args.incremental:
+            from incremental import IncrementalState
+            state = IncrementalState(args.incremental)
+            try:
+                state.update(es, slices=args.scan_slices, limit=args.incremental_limit,
+                             perQuery=args.neg_per_query, seed=args.seed)
+                with instrument.stage('write'):
+                    numQueries = state.write(args.output)
+            finally:
+                state.close()
+        else:
+            if args.prefetch:
+                with instrument.stage('prefetch_collections'):
+                    prefetchCollections(es)
+            if args.useAsync:
+                from asyncReflect import reflectSeriesWithAsync
+                reflections = reflectSeriesWithAsync(inFlight=args.in_flight,
+                                                     maxRequests=args.max_requests,
+                                                     nlpWorkers=args.workers)
+            elif args.spill_dir:
+                reflections = iterReflectSeries(es, workers=args.workers, slices=args.scan_slices)
+            else:
+                reflections = reflectSeries(es, workers=args.workers, slices=args.scan_slices)
+            samplerArgs = dict(perQuery=args.neg_per_query, perDoc=args.neg_per_doc,
+                               stratify=args.neg_stratify, seed=args.seed)
+            if args.spill_dir:
+                from spillInvert import SpilledInversion, SPILL_RUN_SIZE
+                inverted = SpilledInversion(spillDir=args.spill_dir,
+                                            runSize=args.spill_run_size or SPILL_RUN_SIZE)
+                inverted.addAll(reflections.items() if isinstance(reflections, dict) else reflections)
+                negatives = inverted.negativeSampler(**samplerArgs)
+            else:
+                inverted = invertReflections(reflections)
+                negatives = negativeSampler(reflections, inverted, **samplerArgs)
+            try:
+                with instrument.stage('write'):
+                    numQueries = judgmentsToFile(filename=args.output,
+                                                 judgmentsList=iterJudgments(inverted, negatives=negatives))
+            finally:
+                if args.spill_dir:
+                    inverted.close()
     print("Got %s Good Judgments" % numQueries)
-    judgmentsToFile(filename='synth_judg.txt', judgmentsList=judgList)
+    instrument.writeReport(args.report)
 
@@ -1,12 +1,13 @@
 import logging
-from elasticsearch import Elasticsearch
+from esClient import esClient
 from enum import Enum
-from phraseStats import phraseDocFreq
+from phraseStats import phraseDocFreqMany
 from collStats import collectionLookup
 from queryCandidate import QueryCandidate
 from posParser import PhraseExtractor
-from movieDoc import byTitlePhrase
-from popularity import moviePopularity
+from movieDoc import byTitlePhrase, exactTitleLookup
+from popularity import moviePopularity, moviePopularities
+from instrument import cacheLookup
 
 class QueryClass(Enum):
     EXACT_TITLE = 1
@@ -18,12 +19,8 @@ class QueryClass(Enum):
     UNRELATED_TERMS = 1000
 
 
-# Enable logging for this module
+# Logging for this module, configured (or not) by the entry point
 logger = logging.getLogger('reflector')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-logger.addHandler(ch)
 
 
 
@@ -58,13 +55,13 @@ class Reflector:
 
     def addStepDocs(self, stepColl, resp):
         for doc in resp['hits']['hits']:
-            logger.debug("Step Doc %s" % doc['_source']['title'])
+            logger.debug("Step Doc %s", doc['_source']['title'])
             stepColl[doc['_id']] = doc['_source']
 
 
     def stepCollection(self, index='tmdb'):
         if 'belongs_to_collection' not in self.doc or self.doc['belongs_to_collection'] is None:
-            logger.info("Not Part of Collection %s" % self.doc['title'])
+            logger.info("Not Part of Collection %s", self.doc['title'])
             return False
         if self.stepNo == 0:
             return False
@@ -73,7 +70,7 @@ class Reflector:
                                                         collId=collId,
                                                         docId=self.doc['id'])
         self.addStepDocs(stepColl=self.collDocs, resp=resp)
-        logger.debug("Found %s Collection Matches For %s" % (resp['hits']['total'], self.doc['title']))
+        logger.debug("Found %s Collection Matches For %s", resp['hits']['total'], self.doc['title'])
         self.maxCollPop = maxPop
         self.minCollPop = minPop
 
@@ -83,27 +80,9 @@ class Reflector:
         """ Step into movies with 100% mm title match"""
         if self.stepNo == 0:
             return {}
-        allQ = {
-            "size": 10,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"match_phrase": {
-                            "title_sent": {
-                                "query": "SENTINEL_BEGIN %s SENTINEL_END" % self.doc['title'],
-                                "boost": 10000.0}}},
-                    ],
-                    "must_not": [
-                        {"match": {"_id": self.doc['id']}}
-                    ]
-                }
-            }
-        }
-        resp = self.es.search(index=index, body=allQ)
+        resp = exactTitleLookup(es=self.es, title=self.doc['title'], docId=self.doc['id'], index=index)
         self.addStepDocs(stepColl=self.exactTitleDocs, resp=resp)
-        if resp['hits']['total'] > 0:
-            import pdb; pdb.set_trace()
-        logger.debug("Found %s Full Title Matches For %s" % (resp['hits']['total'], self.doc['title']))
+        logger.debug("Found %s Full Title Matches For %s", resp['hits']['total'], self.doc['title'])
 
     def hasPhrase(self, np):
         return np in self.queryCandidates
@@ -116,14 +95,15 @@ class Reflector:
                                    docId=self.docId, docTitle=self.docTitle)
             self.queryCandidates[np] = negQc
 
-    def __init__(self, doc, es, docTitle, docId, index='tmdb', stepNo=1):
+    def __init__(self, doc, es, docTitle, docId, index='tmdb', stepNo=1, phrases=None, collPhrases=None,
+                 memo=None):
         self.doc = doc
         self.docTitle = docTitle
         self.docId = docId
         self.es = es
         self.docPop = moviePopularity(doc)
-        self.maxCollPop = moviePopularity(doc)
-        self.minCollPop = moviePopularity(doc) - 0.01
+        self.maxCollPop = self.docPop
+        self.minCollPop = self.docPop - 0.01
         self.stepNo = stepNo
         self.queryCandidates = {}
         self.textTerms = self.textPhrases = []
@@ -131,7 +111,9 @@ class Reflector:
         self.collDocs = {}
         self.exactTitleDocs = {}
 
-        self.phrases = PhraseExtractor.create(doc['overview'])
+        self.phrases = phrases
+        if self.phrases is None:
+            self.phrases = PhraseExtractor.create(doc['overview'])
 
         # Similar movies needed to make relative
         # Scoring/value decisions
@@ -139,7 +121,7 @@ class Reflector:
             self.stepCollection()
             self.stepExactTitleMatch()
 
-        logger.debug("Adding Title %s" % [self.doc['title']])
+        logger.debug("Adding Title %s", [self.doc['title']])
         qc = QueryCandidate(es=es, queryClass=QueryClass.EXACT_TITLE, queryScore=20.0,
                             docId=docId,
                             docTitle=docTitle,
@@ -151,25 +133,28 @@ class Reflector:
         collRefs = {}
         collQcs = []
         if stepNo > 0:
-            logger.debug("**Recursing Into CollDocs %s!" % stepNo)
+            logger.debug("**Recursing Into CollDocs %s!", stepNo)
             for stepDocId, stepDoc in self.collDocs.items():
-                collRefs[stepDocId] = Reflector(es=es, doc=stepDoc,
-                                                docTitle=stepDoc['title'],
-                                                docId=stepDoc['id'],
-                                                stepNo=stepNo-1)
+                stepReflector = Reflector if memo is None else memo.reflect
+                collRefs[stepDocId] = stepReflector(es=es, doc=stepDoc,
+                                                    docTitle=stepDoc['title'],
+                                                    docId=stepDoc['id'],
+                                                    stepNo=stepNo-1,
+                                                    phrases=(collPhrases or {}).get(stepDocId),
+                                                    memo=memo)
 
                 collQcs.extend([refKeyValue[1] for refKeyValue in collRefs[stepDocId].queryCandidates.items()] )
-            logger.debug("**POP FROM CollDocs %s!" % stepNo)
+            logger.debug("**POP FROM CollDocs %s!", stepNo)
 
 
         # Add titles of sibling collections here
-        for stepDocId, stepDoc in self.collDocs.items():
+        stepDocPops = moviePopularities(list(self.collDocs.values()))
+        for (stepDocId, stepDoc), stepDocPop in zip(self.collDocs.items(), stepDocPops.tolist()):
             if 'title' in stepDoc:
-                stepDocPop = moviePopularity(stepDoc)
                 stepDocTitle = stepDoc['title']
                 # Process movie titles in teh same collection
-                logger.debug("Adding Collection Sibling Title %s vote/min/max %s/%s/%s" % (
-                    stepDoc['title'], stepDocPop, self.minCollPop, self.maxCollPop))
+                logger.debug("Adding Collection Sibling Title %s vote/min/max %s/%s/%s",
+                             stepDoc['title'], stepDocPop, self.minCollPop, self.maxCollPop)
                 queryScore = 17
                 if (self.maxCollPop - self.minCollPop) > 0:
                     voteSpread = (stepDocPop - self.minCollPop) \
@@ -187,7 +172,7 @@ class Reflector:
 
         # Process proper nouns that occur here
         for np in self.phrases.propNouns:
-            logger.debug("Prop Noun Discovered %s" % (qc.qp))
+            logger.debug("Prop Noun Discovered %s", np)
             if np not in self.queryCandidates:
                 qc = QueryCandidate(es=es, queryClass=QueryClass.BODY_PROPER_NOUNS, queryScore=1,
                                     docId=docId,
@@ -208,11 +193,13 @@ class Reflector:
         minDocFreq = 2
         maxDocFreq = 100
         deletePhrases = set()
+        docFreqs = phraseDocFreqMany(es=es, texts=[qc.qp for qc in self.queryCandidates.values()
+                                                   if qc.queryClass == QueryClass.BODY_PROPER_NOUNS])
         for qp, qc in self.queryCandidates.items():
             if qc.queryClass == QueryClass.BODY_PROPER_NOUNS:
-                docFreq, minPop, maxPop = phraseDocFreq(es=es, text=qc.qp)
+                docFreq, minPop, maxPop = docFreqs[qc.qp]
                 voteSpread = min(1, (self.docPop / 7.5) * ((self.docPop - minPop) / (maxPop - minPop)))
-                logger.debug("Phrase %s tf/df/minDf/maxDf :%s/%s/%s/%s | %s/%s/%s => %s" % (qc.qp, qc.tf, docFreq, minDocFreq, maxDocFreq, minPop, self.docPop, maxPop, voteSpread))
+                logger.debug("Phrase %s tf/df/minDf/maxDf :%s/%s/%s/%s | %s/%s/%s => %s", qc.qp, qc.tf, docFreq, minDocFreq, maxDocFreq, minPop, self.docPop, maxPop, voteSpread)
                 if docFreq >= minDocFreq and docFreq <= maxDocFreq:
                     if qc.tf >= 2:
                         qc.queryScore = 10
@@ -220,18 +207,27 @@ class Reflector:
                             qc.queryScore += int(6 * (voteSpread))
                     else:
                         qc.queryScore = 10
-                    qc.tfIdf = qc.tf * (1000 / docFreq)
+                    qc.tfidf = qc.tf * (1000 / docFreq)
                 else:
-                    logger.debug("Phrase %s out of docfreq range" % qc.qp)
+                    logger.debug("Phrase %s out of docfreq range", qc.qp)
                     deletePhrases.add(qc.qp)
                     qc.queryScore = -1
 
         if stepNo >= 1:
             for deleteQuery in deletePhrases:
-                logger.info("DELETING PROPER NOUN %s" % deleteQuery)
+                logger.info("DELETING PROPER NOUN %s", deleteQuery)
                 del self.queryCandidates[deleteQuery]
 
-        logger.info("Done Building Me! \n %s " % self)
+        logger.debug("Done Building Me! \n %s ", self)
+
+    def __getstate__(self):
+        """ Only the reflection itself crosses process boundaries,
+            not the ES client, parse trees or stepped into docs"""
+        state = self.__dict__.copy()
+        state['es'] = None
+        for transient in ('phrases', 'collDocs', 'exactTitleDocs'):
+            state.pop(transient, None)
+        return state
 
     def __str__(self):
         rVal = ""
@@ -251,8 +247,51 @@ class Reflector:
 
 
 
+class SteppedReflection:
+    """ The part of a stepped into Reflector its parent reads"""
+    __slots__ = ('queryCandidates',)
+
+    def __init__(self, queryCandidates):
+        self.queryCandidates = queryCandidates
+
+
+class ReflectionMemo:
+    """ Reflections built during one run, keyed by (docId, stepNo).
+
+        A stepped into reflection only depends on its own doc, so
+        collection siblings get reflected once per run instead of
+        once for every member of their collection. Only what a
+        parent reads, the candidates, is kept"""
+
+    def __init__(self):
+        self.reflections = {}
+        self.built = 0
+        self.reused = 0
+
+    def reflect(self, doc, es, docTitle, docId, stepNo, **kwargs):
+        key = (str(docId), stepNo)
+        try:
+            reflection = self.reflections[key]
+            self.reused += 1
+            cacheLookup('sibling_reflection', True)
+        except KeyError:
+            cacheLookup('sibling_reflection', False)
+            reflection = Reflector(doc=doc, es=es, docTitle=docTitle, docId=docId,
+                                   stepNo=stepNo, **kwargs)
+            # Parents only read its candidates, so the doc, its parse and
+            # the client aren't held for the rest of the run
+            reflection = SteppedReflection(reflection.queryCandidates)
+            self.reflections[key] = reflection
+            self.built += 1
+        return reflection
+
+    def __str__(self):
+        return "built %s reflections, reused %s" % (self.built, self.reused)
+
+
 if __name__ == "__main__":
-    es = Elasticsearch()
+    logging.basicConfig(level=logging.DEBUG)
+    es = esClient()
     from sys import argv
     for doc in byTitlePhrase(titleSearch=argv[1], es=es):
         print(doc['title'])
@@ -0,0 +1,116 @@
+import os
+import heapq
+import marshal
+import shutil
+import tempfile
+from itertools import groupby
+from queryCandidate import QueryCandidate
+from reflector import QueryClass
+from negativeSampler import NegativeSampler
+
+# Candidate rows held in memory before being sorted and spilled as a run
+SPILL_RUN_SIZE = 500000
+
+# Rows per marshal record within a run file
+SPILL_CHUNK_SIZE = 1000
+
+class SpilledInversion:
+    """ invertReflections for corpora whose candidates don't fit in
+        memory. Reflections are added one at a time and reduced to
+        (phrase, grade, slot, generation, ...) rows, spilled to disk as
+        sorted runs. items() merges the runs, giving each phrase's
+        candidates graded best first, so iterJudgments/toJudgList can
+        filter and number queries as the merge streams out.
+
+        A reflection added under a title already seen replaces the
+        earlier one, as assigning into the reflections dict would: it
+        takes over the earlier one's slot, and rows of older generations
+        are dropped while merging. Each phrase's candidates are ordered
+        as invertReflections orders them. Phrases come out sorted, not in
+        the order they were first reflected, so qids differ from the in
+        memory inversion"""
+
+    def __init__(self, spillDir=None, runSize=SPILL_RUN_SIZE):
+        self.tmpDir = tempfile.mkdtemp(prefix='invert', dir=spillDir)
+        self.runSize = runSize
+        self.runs = []
+        self.rows = []
+        self.slots = {}
+        self.docs = []
+        self.generations = []
+
+    def add(self, title, reflection):
+        slot, generation = self.slots.get(title, (len(self.docs), -1))
+        generation += 1
+        if slot == len(self.docs):
+            self.docs.append(None)
+            self.generations.append(None)
+        self.slots[title] = (slot, generation)
+        self.docs[slot] = (reflection.docId, reflection.docTitle)
+        self.generations[slot] = generation
+        for phrase, qc in reflection.queryCandidates.items():
+            self.rows.append((phrase, -qc.asJudgment(), slot, generation,
+                              qc.qp, qc.docId, qc.docTitle, qc.queryClass.value, qc.queryScore))
+        if len(self.rows) >= self.runSize:
+            self._spill()
+
+    def addAll(self, reflections):
+        """ Add an iterable of (title, reflection)"""
+        for title, reflection in reflections:
+            self.add(title, reflection)
+        return self
+
+    def _spill(self):
+        self.rows.sort()
+        filename = os.path.join(self.tmpDir, 'run%05d' % len(self.runs))
+        with open(filename, 'wb') as f:
+            for start in range(0, len(self.rows), SPILL_CHUNK_SIZE):
+                marshal.dump(self.rows[start:start + SPILL_CHUNK_SIZE], f)
+        self.runs.append(filename)
+        self.rows = []
+
+    def _readRun(self, filename):
+        with open(filename, 'rb') as f:
+            while True:
+                try:
+                    chunk = marshal.load(f)
+                except EOFError:
+                    return
+                yield from chunk
+
+    def _merged(self):
+        """ Rows of all runs and those still in memory, sorted, and
+            without rows of since replaced reflections"""
+        self.rows.sort()
+        runs = [self._readRun(filename) for filename in self.runs] + [iter(self.rows)]
+        for row in heapq.merge(*runs):
+            if self.generations[row[2]] == row[3]:
+                yield row
+
+    def items(self):
+        """ (phrase, QueryCandidates best graded first) for each phrase"""
+        for phrase, rows in groupby(self._merged(), key=lambda row: row[0]):
+            yield phrase, [QueryCandidate(es=None, queryPhrase=qp, docId=docId, docTitle=docTitle,
+                                          queryClass=QueryClass(queryClass), queryScore=queryScore)
+                           for _, grade, slot, generation, qp, docId, docTitle, queryClass, queryScore
+                           in rows]
+
+    def phraseFreqs(self):
+        """ How many docs reflect each phrase, in one pass of the merge"""
+        return {phrase: sum(1 for row in rows)
+                for phrase, rows in groupby(self._merged(), key=lambda row: row[0])}
+
+    def negativeSampler(self, perDoc=None, **kwargs):
+        """ negativeSampler over the spilled docs and phrases. Phrase
+            frequencies are only gathered if per doc sampling needs them"""
+        phraseFreqs = self.phraseFreqs() if perDoc else {}
+        return NegativeSampler(docs=list(self.docs), phraseFreqs=phraseFreqs, perDoc=perDoc, **kwargs)
+
+    def close(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()